@@ -0,0 +1,113 @@
+import asyncio
+import time
+import deadline
+import metrics
+from typing import Any
+from tokens import count_prompt_tokens
+
+metrics.describe("admission_wait_seconds", "Time completions waited for their deployment's tokens/requests per minute quota")
+metrics.describe("admission_tokens_total", "Estimated tokens (prompt and max_tokens) of the completions admitted")
+metrics.describe("admission_rejected_total", "Completions turned away because the quota wouldn't free up in time")
+
+class QuotaExceeded(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Refills at per_minute / 60 per second, up to burst_seconds worth. Reservations are taken right away and may leave the
+# bucket negative, each caller waits until its own reservation is paid back, so callers are served in arrival order. A
+# reservation larger than the bucket only waits for it to be full, so with a small quota any single call still fits
+# when nothing else is queued, and the calls after it wait for it to be paid back
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        now = time.monotonic()
+        if self.tokens < self.capacity:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+    def give(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+# Tokens and requests per minute of one deployment, either can be 0 for no limit
+class DeploymentQuota:
+    def __init__(self, deployment: str, tokens_per_minute: float, requests_per_minute: float):
+        self.deployment = deployment
+        self.buckets = []
+        if tokens_per_minute:
+            self.buckets.append(("tokens", TokenBucket(tokens_per_minute)))
+        if requests_per_minute:
+            self.buckets.append(("requests", TokenBucket(requests_per_minute)))
+
+    # Reserves the quota for a call and returns how long to wait before sending it, or raises QuotaExceeded (reserving
+    # nothing) if that's longer than max_wait
+    def reserve(self, cost: int, max_wait: float) -> float:
+        amounts = {"tokens": cost, "requests": 1}
+        wait = self.check(amounts, max_wait)
+        for kind, bucket in self.buckets:
+            bucket.take(amounts[kind])
+        return wait
+
+    # How long a call of these amounts would wait, raises QuotaExceeded if that's longer than max_wait
+    def check(self, amounts: dict[str, int], max_wait: float) -> float:
+        wait, kind = max(((bucket.wait_time(amounts[kind]), kind) for kind, bucket in self.buckets), default=(0.0, None))
+        if wait > max_wait:
+            metrics.inc("admission_rejected_total", deployment=self.deployment, limit=kind)
+            raise QuotaExceeded(f"Too many requests for {self.deployment}, try again in {wait:.0f}s", wait)
+        return wait
+
+    def refund(self, cost: int):
+        amounts = {"tokens": cost, "requests": 1}
+        for kind, bucket in self.buckets:
+            bucket.give(amounts[kind])
+
+# What the service counts against the tokens per minute quota when a call arrives: the prompt tokens plus max_tokens for
+# each completion asked for
+def estimate_tokens(args: dict[str, Any]) -> int:
+    prompts = args.get("prompt") or ""
+    prompts = prompts if isinstance(prompts, list) else [prompts]
+    return sum(count_prompt_tokens(p) for p in prompts) + (args.get("max_tokens") or 16) * (args.get("n") or 1) * len(prompts)
+
+# Queues completions in front of the OpenAI deployments so bursts wait their turn under the quota instead of all being
+# throttled by the service. A call that would have to wait more than max_wait seconds, or past the request's deadline,
+# fails right away with QuotaExceeded. Calls to deployments without a quota go straight through
+class AdmissionController:
+    def __init__(self, quotas: dict[str, tuple[float, float]], max_wait: float = 10):
+        self.quotas = {deployment: DeploymentQuota(deployment, tpm, rpm) for deployment, (tpm, rpm) in quotas.items() if tpm or rpm}
+        self.max_wait = max_wait
+
+    def max_wait_now(self) -> float:
+        left = deadline.remaining()
+        return self.max_wait if left is None else min(self.max_wait, left)
+
+    # Sheds a request before any work is done for it when the deployments it uses are already backed up for longer than
+    # it could wait
+    def check(self, deployments: list[str]):
+        for deployment in deployments:
+            quota = self.quotas.get(deployment)
+            if quota is not None:
+                quota.check({"tokens": 0, "requests": 0}, self.max_wait_now())
+
+    async def admit(self, args: dict[str, Any]):
+        quota = self.quotas.get(args.get("engine"))
+        if quota is None:
+            return
+        cost = estimate_tokens(args)
+        wait = quota.reserve(cost, self.max_wait_now())
+        metrics.observe("admission_wait_seconds", wait, deployment=quota.deployment)
+        metrics.inc("admission_tokens_total", cost, deployment=quota.deployment)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                quota.refund(cost)
+                raise
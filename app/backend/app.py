@@ -1,16 +1,32 @@
 import os
-import mimetypes
+import gzip
+import json
+import math
+import zlib
 import time
 import logging
+import aiohttp
 import openai
-from flask import Flask, request, jsonify
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+import deadline
+import llm
+import metrics
+from typing import AsyncGenerator
+from quart import Quart, Response, request, jsonify
+from quart.wrappers.response import DataBody
+from azure.identity.aio import DefaultAzureCredential
+from azure.search.documents.aio import SearchClient
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient
+from retrieval import IndexVersion, Retriever
+from resilience import CircuitBreaker, CircuitOpen, Policy
+from admission import AdmissionController, QuotaExceeded
+from cache import Coalescer, TTLCache
+from content import ContentStore
+from text import normalize
+from thoughts import TraceStore, render_html
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT") or "mystorageaccount"
@@ -25,6 +41,66 @@ KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 
+# Search results are cached for repeated questions, entries expire after SEARCH_CACHE_TTL seconds and right after 
+# scripts/prepdocs.py updates the index (the app checks for that every INDEX_VERSION_CHECK_INTERVAL seconds)
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE") or 1000)
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL") or 300)
+INDEX_VERSION_CHECK_INTERVAL = float(os.environ.get("INDEX_VERSION_CHECK_INTERVAL") or 30)
+
+# Token budgets for the chat history in the prompt that generates the search query and in the prompt that generates the answer
+CHAT_HISTORY_QUERY_TOKENS = int(os.environ.get("CHAT_HISTORY_QUERY_TOKENS") or 1000)
+CHAT_HISTORY_ANSWER_TOKENS = int(os.environ.get("CHAT_HISTORY_ANSWER_TOKENS") or 1000)
+
+# Search with the question as asked while the chat search query is being generated, see ChatReadRetrieveReadApproach
+CHAT_SPECULATIVE_SEARCH = (os.environ.get("CHAT_SPECULATIVE_SEARCH") or "false").lower() == "true"
+
+# Answers to /ask requests with temperature 0 are cached too, with the same invalidation as search results
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE") or 1000)
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL") or 3600)
+
+# Requests are answered within REQUEST_TIMEOUT seconds or fail with a 504, agents stop iterating early to answer in time. 
+# Each search and completion (until the first token for streamed ones) also takes at most SEARCH_TIMEOUT and COMPLETION_TIMEOUT seconds
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT") or 60)
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT") or 10)
+COMPLETION_TIMEOUT = float(os.environ.get("COMPLETION_TIMEOUT") or 30)
+
+# Calls to OpenAI and Cognitive Search that fail with 429/5xx, a connection error or a timeout are retried up to 
+# RETRY_COUNT times, with jittered exponential backoff from RETRY_BACKOFF seconds (or after Retry-After). With 
+# HEDGE_PERCENTILE set (e.g. 95), a call slower than that percentile of the recent ones gets a duplicate and the first
+# answer wins. After CIRCUIT_FAILURE_THRESHOLD failures in a row a dependency is failed fast (503) for CIRCUIT_RESET_TIMEOUT seconds
+RETRY_COUNT = int(os.environ.get("RETRY_COUNT") or 3)
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF") or 0.5)
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE") or 0)
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD") or 5)
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT") or 30)
+
+# Tokens and requests per minute quotas of the OpenAI deployments (0 for none). Completions queue in order to stay under
+# them, and requests that would have to wait more than ADMISSION_MAX_WAIT seconds (or past their timeout) get a 429.
+# Each worker process admits its even share, the quotas divided by WEB_CONCURRENCY (the number of workers, set by 
+# gunicorn.conf.py), rather than sharing the queue state between workers: no shared store to run, at the cost of a 
+# worker not using the share of idle ones
+AZURE_OPENAI_GPT_DEPLOYMENT_TPM = int(os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT_TPM") or 0)
+AZURE_OPENAI_GPT_DEPLOYMENT_RPM = int(os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT_RPM") or 0)
+AZURE_OPENAI_CHATGPT_DEPLOYMENT_TPM = int(os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT_TPM") or 0)
+AZURE_OPENAI_CHATGPT_DEPLOYMENT_RPM = int(os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT_RPM") or 0)
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT") or 10)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY") or 1)
+
+# The thought process of each answer is kept for TRACE_TTL seconds in TRACE_DIR (a temporary directory by default, shared
+# by the workers) and sent rendered only to clients that ask for it, see present()
+TRACE_DIR = os.environ.get("TRACE_DIR") or None
+TRACE_TTL = float(os.environ.get("TRACE_TTL") or 3600)
+
+# JSON responses larger than COMPRESS_MIN_SIZE bytes, and streamed responses, are gzipped for clients that accept it
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE") or 1024)
+
+# Content files (the PDF pages citations point to) are cached on local disk, up to CONTENT_CACHE_SIZE bytes per worker 
+# and for files of up to CONTENT_CACHE_MAX_FILE_SIZE bytes, and checked against storage every CONTENT_CACHE_REVALIDATE seconds
+CONTENT_CACHE_DIR = os.environ.get("CONTENT_CACHE_DIR") or None
+CONTENT_CACHE_SIZE = int(os.environ.get("CONTENT_CACHE_SIZE") or 256 * 1024 * 1024)
+CONTENT_CACHE_MAX_FILE_SIZE = int(os.environ.get("CONTENT_CACHE_MAX_FILE_SIZE") or 8 * 1024 * 1024)
+CONTENT_CACHE_REVALIDATE = float(os.environ.get("CONTENT_CACHE_REVALIDATE") or 300)
+
 # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed, 
 # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the 
 # keys for each service
@@ -37,82 +113,265 @@ openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
 openai.api_version = "2022-12-01"
 
 # Comment these two lines out if using keys, set your API key in the OPENAI_API_KEY environment variable instead
+# (the token itself is acquired when the app starts serving, see setup_clients below)
 openai.api_type = "azure_ad"
-openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
-openai.api_key = openai_token.token
+openai_token = None
 
-# Set up clients for Cognitive Search and Storage
+# The OpenAI SDK opens (and closes) an HTTP session for every call unless one is set, so each worker makes its
+# completions through a single session and reuses its connections, see setup_clients and use_openai_session
+openai_session = None
+
+# Set up clients for Cognitive Search and Storage. These are the asyncio versions of the clients, so that a single
+# process can keep many requests in flight while waiting on Cognitive Search, Storage and OpenAI. Searches are retried
+# by the search policy below rather than by the SDK, so retries and the circuit breaker see every failure once
 search_client = SearchClient(
     endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
     index_name=AZURE_SEARCH_INDEX,
-    credential=azure_credential)
+    credential=azure_credential,
+    retry_total=0)
 blob_client = BlobServiceClient(
     account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", 
     credential=azure_credential)
 blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+content_store = ContentStore(blob_container, CONTENT_CACHE_SIZE, CONTENT_CACHE_MAX_FILE_SIZE, CONTENT_CACHE_REVALIDATE, CONTENT_CACHE_DIR)
+
+def make_policy(name: str) -> Policy:
+    return Policy(name, retries=RETRY_COUNT, backoff=RETRY_BACKOFF, hedge_percentile=HEDGE_PERCENTILE,
+                  breaker=CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT))
+
+# All approaches search through the same retriever so they share its cache and its circuit breaker
+retriever = Retriever(search_client, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT, 
+                      index_version=IndexVersion(blob_container, INDEX_VERSION_CHECK_INTERVAL),
+                      cache_size=SEARCH_CACHE_SIZE, 
+                      cache_ttl=SEARCH_CACHE_TTL,
+                      timeout=SEARCH_TIMEOUT,
+                      policy=make_policy("search"))
+llm.timeout = COMPLETION_TIMEOUT
+llm.policy = make_policy("openai")
+llm.admission = AdmissionController({
+    AZURE_OPENAI_GPT_DEPLOYMENT: (AZURE_OPENAI_GPT_DEPLOYMENT_TPM / WEB_CONCURRENCY, AZURE_OPENAI_GPT_DEPLOYMENT_RPM / WEB_CONCURRENCY),
+    AZURE_OPENAI_CHATGPT_DEPLOYMENT: (AZURE_OPENAI_CHATGPT_DEPLOYMENT_TPM / WEB_CONCURRENCY, AZURE_OPENAI_CHATGPT_DEPLOYMENT_RPM / WEB_CONCURRENCY)
+}, ADMISSION_MAX_WAIT)
 
 # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
 # or some derivative, here we include several for exploration purposes
 ask_approaches = {
-    "rtr": RetrieveThenReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rrr": ReadRetrieveReadApproach(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT),
-    "rda": ReadDecomposeAsk(search_client, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
+    "rtr": RetrieveThenReadApproach(retriever, AZURE_OPENAI_GPT_DEPLOYMENT),
+    "rrr": ReadRetrieveReadApproach(retriever, AZURE_OPENAI_GPT_DEPLOYMENT),
+    "rda": ReadDecomposeAsk(retriever, AZURE_OPENAI_GPT_DEPLOYMENT)
 }
 
+# Identical /ask requests that arrive while one is running wait for its answer instead of running again
+answer_cache = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+answer_coalescer = Coalescer()
+
+metrics.describe("request_seconds", "Duration of /ask and /chat requests, until the last byte for streamed ones")
+metrics.describe("answer_cache_hits_total", "/ask answers served from the answer cache")
+metrics.describe("answer_cache_misses_total", "Cacheable /ask requests that ran the approach")
+metrics.describe("answer_coalesced_total", "/ask requests that waited for an identical request in flight")
+
+trace_store = TraceStore(TRACE_DIR, TRACE_TTL)
+
 chat_approaches = {
-    "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
+    "rrr": ChatReadRetrieveReadApproach(retriever, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_GPT_DEPLOYMENT, 
+                                        query_history_tokens=CHAT_HISTORY_QUERY_TOKENS, 
+                                        answer_history_tokens=CHAT_HISTORY_ANSWER_TOKENS,
+                                        speculative_search=CHAT_SPECULATIVE_SEARCH)
 }
 
-app = Flask(__name__)
+app = Quart(__name__)
+
+@app.before_serving
+async def setup_clients():
+    global openai_token, openai_session
+    openai_token = await azure_credential.get_token("https://cognitiveservices.azure.com/.default")
+    openai.api_key = openai_token.token
+    openai_session = aiohttp.ClientSession()
+    openai.aiosession.set(openai_session)
+
+# openai.aiosession is a context variable, each request's task sets it again (tasks it starts inherit it)
+@app.before_request
+async def use_openai_session():
+    openai.aiosession.set(openai_session)
+
+@app.after_serving
+async def close_clients():
+    await search_client.close()
+    await blob_client.close()
+    await azure_credential.close()
+    await openai_session.close()
+    content_store.close()
+
+@app.route("/metrics")
+async def get_metrics():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 @app.route("/", defaults={"path": "index.html"})
 @app.route("/<path:path>")
-def static_file(path):
-    return app.send_static_file(path)
+async def static_file(path):
+    return await app.send_static_file(path)
 
 # Serve content files from blob storage from within the app to keep the example self-contained. 
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Files are streamed, support range and conditional requests, and small ones are cached
+# on local disk (see ContentStore)
 @app.route("/content/<path>")
-def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    return blob.readall(), 200, {"Content-Type": mime_type, "Content-Disposition": f"inline; filename={path}"}
+async def content_file(path):
+    return await content_store.get_response(path, request)
     
 @app.route("/ask", methods=["POST"])
-def ask():
-    ensure_openai_token()
-    approach = request.json["approach"]
+async def ask():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    approach = request_json["approach"]
     try:
         impl = ask_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["question"], request.json.get("overrides") or {})
-        return jsonify(r)
+        llm.admission.check([AZURE_OPENAI_GPT_DEPLOYMENT])
+        if request_json.get("stream"):
+            r = impl.run_stream(request_json["question"], request_json.get("overrides") or {})
+            compress = accepts_gzip()
+            headers = {"Content-Type": "application/x-ndjson", **({"Content-Encoding": "gzip", "Vary": "Accept-Encoding"} if compress else {})}
+            return format_as_ndjson(r, "/ask", approach, request_json.get("overrides") or {}, compress), 200, headers
+        with deadline.scope(REQUEST_TIMEOUT), metrics.timer("request_seconds", route="/ask", approach=approach):
+            r = await deadline.run(run_ask(approach, impl, request_json["question"], request_json.get("overrides") or {}), "request")
+        return jsonify(await present(r, request_json.get("overrides") or {}))
+    except deadline.DeadlineExceeded as e:
+        logging.warning(f"Timeout in /ask: {e}")
+        return jsonify({"error": str(e)}), 504
+    except CircuitOpen as e:
+        logging.warning(f"Failing fast in /ask: {e}")
+        return jsonify({"error": str(e)}), 503
+    except QuotaExceeded as e:
+        logging.warning(f"Shedding load in /ask: {e}")
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
     
 @app.route("/chat", methods=["POST"])
-def chat():
-    ensure_openai_token()
-    approach = request.json["approach"]
+async def chat():
+    await ensure_openai_token()
+    request_json = await request.get_json()
+    approach = request_json["approach"]
     try:
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(request.json["history"], request.json.get("overrides") or {})
-        return jsonify(r)
+        llm.admission.check([AZURE_OPENAI_GPT_DEPLOYMENT, AZURE_OPENAI_CHATGPT_DEPLOYMENT])
+        if request_json.get("stream"):
+            r = impl.run_stream(request_json["history"], request_json.get("overrides") or {})
+            compress = accepts_gzip()
+            headers = {"Content-Type": "application/x-ndjson", **({"Content-Encoding": "gzip", "Vary": "Accept-Encoding"} if compress else {})}
+            return format_as_ndjson(r, "/chat", approach, request_json.get("overrides") or {}, compress), 200, headers
+        with deadline.scope(REQUEST_TIMEOUT), metrics.timer("request_seconds", route="/chat", approach=approach):
+            r = await deadline.run(impl.run(request_json["history"], request_json.get("overrides") or {}), "request")
+        return jsonify(await present(r, request_json.get("overrides") or {}))
+    except deadline.DeadlineExceeded as e:
+        logging.warning(f"Timeout in /chat: {e}")
+        return jsonify({"error": str(e)}), 504
+    except CircuitOpen as e:
+        logging.warning(f"Failing fast in /chat: {e}")
+        return jsonify({"error": str(e)}), 503
+    except QuotaExceeded as e:
+        logging.warning(f"Shedding load in /chat: {e}")
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(math.ceil(e.retry_after))}
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
-def ensure_openai_token():
+async def run_ask(approach: str, impl, question: str, overrides: dict) -> dict:
+    # Every override but "thoughts" changes the prompt or the search, so they are part of the key, and the index version
+    # makes answers from before a re-index unreachable
+    key = (approach, 
+           normalize(question), 
+           json.dumps({k: v for k, v in overrides.items() if v is not None and k != "thoughts"}, sort_keys=True), 
+           await retriever.index_version.get())
+    
+    # Only deterministic answers are cached, other requests are still coalesced while in flight
+    cacheable = overrides.get("temperature") == 0
+    if cacheable:
+        r = answer_cache.get(key)
+        if r is not None:
+            metrics.inc("answer_cache_hits_total", approach=approach)
+            return r
+        metrics.inc("answer_cache_misses_total", approach=approach)
+
+    async def run():
+        r = await impl.run(question, overrides)
+        if cacheable:
+            answer_cache.set(key, r)
+        return r
+
+    if answer_coalescer.is_in_flight(key):
+        metrics.inc("answer_coalesced_total", approach=approach)
+    return await answer_coalescer.run(key, run)
+
+# Answers come with the trace id of their thought process, which clients fetch from /trace/<id> if they want to show it.
+# With the "thoughts" override the thought process is rendered and sent along instead, as it used to be
+async def present(r: dict, overrides: dict) -> dict:
+    r = dict(r)
+    trace = r.pop("trace", None)
+    if trace is None:
+        return r
+    if overrides.get("thoughts"):
+        r["thoughts"] = render_html(trace)
+    else:
+        r["trace_id"] = await trace_store.save(trace)
+    return r
+
+# Streamed responses are sent as newline delimited JSON, one object per line: {"data_points": [...]} as soon as retrieval 
+# is done, then {"answer": "..."} for each chunk of the answer as it's generated, and {"trace_id": "..."} (or 
+# {"thoughts": "..."}, see present) at the end. Compressed streams are flushed after each line so chunks aren't held back
+async def format_as_ndjson(r: AsyncGenerator[dict, None], route: str, approach: str, overrides: dict, compress: bool) -> AsyncGenerator[bytes, None]:
+    compressor = zlib.compressobj(5, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    def encode(event: dict) -> bytes:
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+        return compressor.compress(line) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else line
+
+    with deadline.scope(REQUEST_TIMEOUT), metrics.timer("request_seconds", route=route, approach=approach):
+        try:
+            async for event in r:
+                yield encode(await present(event, overrides) if "trace" in event else event)
+        except Exception as e:
+            logging.exception(f"Exception in {route} while streaming")
+            yield encode({"error": str(e)})
+        if compressor:
+            yield compressor.flush()
+
+# Thought process of an answer by its trace id, rendered as HTML like the "thoughts" of answers or, with ?format=json,
+# as the trace events
+@app.route("/trace/<trace_id>")
+async def get_trace(trace_id):
+    trace = await trace_store.load(trace_id)
+    if trace is None:
+        return jsonify({"error": "trace not found or expired"}), 404
+    if request.args.get("format") == "json":
+        return jsonify({"trace": trace})
+    return jsonify({"thoughts": render_html(trace)})
+
+def accepts_gzip() -> bool:
+    return request.accept_encodings["gzip"] > 0
+
+# Gzips JSON responses (answers, traces) for clients that accept it. Content files and static files are left as they are
+@app.after_request
+async def compress_response(response: Response) -> Response:
+    if (response.mimetype != "application/json" or not isinstance(response.response, DataBody)
+            or "Content-Encoding" in response.headers or not accepts_gzip()):
+        return response
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+async def ensure_openai_token():
     global openai_token
     if openai_token.expires_on < int(time.time()) - 60:
-        openai_token = azure_credential.get_token("https://cognitiveservices.azure.com/.default")
+        openai_token = await azure_credential.get_token("https://cognitiveservices.azure.com/.default")
         openai.api_key = openai_token.token
     
 if __name__ == "__main__":
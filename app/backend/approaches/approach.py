@@ -1,3 +1,19 @@
+import metrics
+from typing import AsyncGenerator
+
+metrics.describe("approach_stage_seconds", "Duration of each stage of the approaches (query_rewrite, search, answer, agent)")
+
 class Approach:
-    def run(self, q: str, use_summaries: bool) -> any:
+    # Label of the approach in the metrics
+    name = None
+
+    async def run(self, q: str, use_summaries: bool) -> any:
         raise NotImplementedError
+
+    # Streaming version of run, yields the data points first, then the answer in chunks, and the trace last. Approaches
+    # that can't stream the completion (e.g. agents) fall back to this, which sends the whole answer as a single chunk
+    async def run_stream(self, q: str, overrides: dict) -> AsyncGenerator[dict, None]:
+        r = await self.run(q, overrides)
+        yield {"data_points": r["data_points"]}
+        yield {"answer": r["answer"]}
+        yield {"trace": r["trace"]}
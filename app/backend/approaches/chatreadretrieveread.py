@@ -1,13 +1,26 @@
-import openai
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
+import asyncio
+import llm
+import metrics
 from approaches.approach import Approach
-from text import nonewlines
+from cache import TTLCache
+from retrieval import Retriever
+from sources import format_sources
+from text import normalize, word_overlap
+from tokens import count_tokens, TURN_OVERHEAD_TOKENS
+from typing import AsyncGenerator, Callable
+
+metrics.describe("query_rewrite_cache_hits_total", "Chat search queries reused from the query rewrite cache")
+metrics.describe("query_rewrite_cache_misses_total", "Chat search queries generated with a completion")
+metrics.describe("query_rewrite_skipped_total", "First chat turns searched with the question as asked")
+metrics.describe("speculative_search_used_total", "Speculative searches whose results were used as they were")
+metrics.describe("speculative_search_merged_total", "Speculative searches whose results were merged after the results for the generated query")
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
 # top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion 
 # (answer) with that prompt.
 class ChatReadRetrieveReadApproach(Approach):
+    name = "chat-rrr"
+
     prompt_prefix = """<|im_start|>system
 Assistant helps the company employees with their healthcare plan questions, and questions about the employee handbook. Be brief in your answers.
 Answer ONLY with the facts listed in the list of sources below. If there isn't enough information below, say you don't know. Do not generate answers that don't use the sources below. If asking a clarifying question to the user would help, ask the question.
@@ -41,46 +54,63 @@ Question:
 Search query:
 """
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Prompt tokens for the sources, filled with the top ranked ones
+    sources_token_budget = 1500
+
+    # With speculative search, the question is searched as asked while the search query is generated. Its results are
+    # used when this share of the query's words are in the question, otherwise the query is searched too and the
+    # speculative results only fill what's left of the sources budget
+    speculative_match = 0.75
+
+    def __init__(self, retriever: Retriever, chatgpt_deployment: str, gpt_deployment: str, query_cache_size: int = 1000, query_cache_ttl: float = 3600,
+                 query_history_tokens: int = 1000, answer_history_tokens: int = 1000, speculative_search: bool = False):
+        self.retriever = retriever
         self.chatgpt_deployment = chatgpt_deployment
         self.gpt_deployment = gpt_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
-
-    def run(self, history: list[dict], overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        prompt = self.query_prompt_template.format(chat_history=self.get_chat_history_as_text(history, include_last_turn=False), question=history[-1]["user"])
-        completion = openai.Completion.create(
-            engine=self.gpt_deployment, 
-            prompt=prompt, 
-            temperature=0.0, 
-            max_tokens=32, 
-            n=1, 
-            stop=["\n"])
-        q = completion.choices[0].text
+        self.query_history_tokens = query_history_tokens
+        self.answer_history_tokens = answer_history_tokens
+        self.query_cache = TTLCache(query_cache_size, query_cache_ttl)
+        self.speculative_search = speculative_search
+
+    async def run(self, history: list[dict], overrides: dict) -> any:
+        q, results, prompt = await self.retrieve_and_build_prompt(history, overrides)
+
+        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+        completion = await llm.complete(self.name, "answer", **self.completion_args(prompt, overrides))
+
+        return {"data_points": results, "answer": completion.choices[0].text, "trace": self.trace(q, prompt)}
+
+    async def run_stream(self, history: list[dict], overrides: dict) -> AsyncGenerator[dict, None]:
+        q, results, prompt = await self.retrieve_and_build_prompt(history, overrides)
+        yield {"data_points": results}
+
+        # STEP 3: Same as above, but send the answer to the client as the tokens come in
+        async for chunk in llm.stream(self.name, "answer", **self.completion_args(prompt, overrides)):
+            if chunk.choices and chunk.choices[0].text:
+                yield {"answer": chunk.choices[0].text}
+
+        yield {"trace": self.trace(q, prompt)}
+
+    async def retrieve_and_build_prompt(self, history: list[dict], overrides: dict) -> tuple[str, list[str], str]:
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question. Only when that
+        # takes a completion, the question may be searched as asked in the meantime
+        question = history[-1]["user"]
+        speculative = None
+        def speculate():
+            nonlocal speculative
+            speculative = asyncio.ensure_future(self.retriever.search(question, overrides))
+        try:
+            with metrics.timer("approach_stage_seconds", approach=self.name, stage="query_rewrite"):
+                q = await self.rewrite_query(history, speculate if self.speculative_search else None)
+        except BaseException:
+            if speculative:
+                speculative.cancel()
+            raise
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+        with metrics.timer("approach_stage_seconds", approach=self.name, stage="search"):
+            q, docs = await self.search(q, question, speculative, overrides)
+        results = format_sources(self.name, docs, overrides, self.sources_token_budget)
         content = "\n".join(results)
 
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
@@ -88,27 +118,92 @@ Search query:
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
         if prompt_override is None:
-            prompt = self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+            prompt = self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=self.get_chat_history_as_text(history, max_tokens=self.answer_history_tokens), follow_up_questions_prompt=follow_up_questions_prompt)
         elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+            prompt = self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=self.get_chat_history_as_text(history, max_tokens=self.answer_history_tokens), follow_up_questions_prompt=follow_up_questions_prompt)
         else:
-            prompt = prompt_override.format(sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+            prompt = prompt_override.format(sources=content, chat_history=self.get_chat_history_as_text(history, max_tokens=self.answer_history_tokens), follow_up_questions_prompt=follow_up_questions_prompt)
 
-        # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        completion = openai.Completion.create(
-            engine=self.chatgpt_deployment, 
+        return q, results, prompt
+
+    # Returns the query that was searched for along with the results
+    async def search(self, q: str, question: str, speculative: asyncio.Future, overrides: dict) -> tuple[str, list[dict]]:
+        if speculative is None:
+            return q, await self.retriever.search(q, overrides)
+        if word_overlap(q, question) >= self.speculative_match:
+            try:
+                docs = await speculative
+                metrics.inc("speculative_search_used_total")
+                return question, docs
+            except Exception:
+                return q, await self.retriever.search(q, overrides)
+
+        try:
+            docs = await self.retriever.search(q, overrides)
+        except BaseException:
+            speculative.cancel()
+            raise
+        try:
+            speculative_docs = await speculative
+        except Exception:
+            return q, docs
+        metrics.inc("speculative_search_merged_total")
+        seen = {(doc["sourcepage"], doc["content"]) for doc in docs}
+        return q, docs + [doc for doc in speculative_docs if (doc["sourcepage"], doc["content"]) not in seen]
+
+    # on_completion is called right before the completion, when the query isn't known without one
+    async def rewrite_query(self, history: list[dict], on_completion: Callable[[], None] = None) -> str:
+        question = history[-1]["user"]
+
+        # On the first turn there's no conversation to fold into the query, so search with the question as asked. Questions 
+        # that may not be in English still go through the completion, which translates them
+        if len(history) == 1 and question.isascii():
+            metrics.inc("query_rewrite_skipped_total")
+            return question
+
+        # The rewrite runs at temperature 0, so the same conversation always gives the same query
+        chat_history = self.get_chat_history_as_text(history, include_last_turn=False, max_tokens=self.query_history_tokens)
+        key = (normalize(chat_history), normalize(question))
+        q = self.query_cache.get(key)
+        if q is not None:
+            metrics.inc("query_rewrite_cache_hits_total")
+            return q
+        metrics.inc("query_rewrite_cache_misses_total")
+
+        if on_completion:
+            on_completion()
+        prompt = self.query_prompt_template.format(chat_history=chat_history, question=question)
+        completion = await llm.complete(self.name, "query_rewrite",
+            engine=self.gpt_deployment, 
             prompt=prompt, 
-            temperature=overrides.get("temperature") or 0.7, 
-            max_tokens=1024, 
+            temperature=0.0, 
+            max_tokens=32, 
             n=1, 
-            stop=["<|im_end|>", "<|im_start|>"])
+            stop=["\n"])
+        q = completion.choices[0].text
+        self.query_cache.set(key, q)
+        return q
+
+    def completion_args(self, prompt: str, overrides: dict) -> dict:
+        return {
+            "engine": self.chatgpt_deployment, 
+            "prompt": prompt, 
+            "temperature": 0.7 if overrides.get("temperature") is None else overrides["temperature"], 
+            "max_tokens": 1024, 
+            "n": 1, 
+            "stop": ["<|im_end|>", "<|im_start|>"]}
 
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+    def trace(self, q: str, prompt: str) -> list[dict]:
+        return [{"type": "search", "query": q}, {"type": "prompt", "text": prompt}]
     
-    def get_chat_history_as_text(self, history, include_last_turn=True, approx_max_tokens=1000) -> str:
-        history_text = ""
+    # Renders the most recent turns that fit in max_tokens, oldest first. The most recent turn is included even if it alone goes over
+    def get_chat_history_as_text(self, history: list[dict], include_last_turn: bool = True, max_tokens: int = 1000) -> str:
+        turns = []
+        total_tokens = 0
         for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" +"\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break    
-        return history_text
\ No newline at end of file
+            tokens = count_tokens(h["user"]) + (count_tokens(h["bot"]) if h.get("bot") else 0) + TURN_OVERHEAD_TOKENS
+            if turns and total_tokens + tokens > max_tokens:
+                break
+            total_tokens += tokens
+            turns.append("<|im_start|>user" + "\n" + h["user"] + "\n" + "<|im_end|>" + "\n" + "<|im_start|>assistant" + "\n" + (h.get("bot") + "<|im_end|>" if h.get("bot") else "") + "\n")
+        return "".join(reversed(turns))
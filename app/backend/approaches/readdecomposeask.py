@@ -1,49 +1,58 @@
-import openai
+import functools
 import re
+import metrics
+from contextvars import ContextVar
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.prompts import PromptTemplate, BasePromptTemplate
-from langchain.callbacks.manager import CallbackManager
+from langchain.prompts import PromptTemplate
+from langchain.chains import LLMChain
 from langchain.agents import Tool, AgentExecutor
 from langchain.agents.react.base import ReActDocstoreAgent
-from langchainadapters import HtmlCallbackHandler
-from text import nonewlines
-from typing import List
+from langchainadapters import TraceCallbackHandler, MetricsCallbackHandler, arun_within_deadline
+from llm import agent_llm
+from retrieval import Retriever
+from sources import format_sources
+
+# Overrides and search results of the request being answered, see ReadRetrieveReadApproach
+request_state = ContextVar("rda_request_state")
 
 class ReadDecomposeAsk(Approach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    name = "rda"
+
+    # Tokens for the sources in each search observation, and for each source in it. Observations pile up in the prompt 
+    # with every iteration, so sources are kept short
+    sources_token_budget = 1280
+    source_token_limit = 128
+
+    def __init__(self, retriever: Retriever, openai_deployment: str):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
+        # Tools and agents are shared by all requests, agents are built once for each temperature and prompt
+        self.tools = [
+            Tool(name="Search", func=lambda _: "Not implemented", coroutine=self.search_and_store, description="useful for when you need to ask with search"),
+            Tool(name="Lookup", func=lambda _: "Not implemented", coroutine=self.lookup, description="useful for when you need to ask with lookup")
+        ]
+        self.get_agent = functools.lru_cache(maxsize=16)(self.create_agent)
+        self.get_agent(0.3, None)
+
+    def create_agent(self, temperature: float, prompt_prefix: str) -> AgentExecutor:
+        prompt = PromptTemplate.from_examples(
+            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
+        agent = ReActDocstoreAgent(llm_chain=LLMChain(llm=agent_llm(self.name, self.openai_deployment, temperature), prompt=prompt),
+                                   allowed_tools=[t.name for t in self.tools])
+        return AgentExecutor.from_agent_and_tools(agent, self.tools, verbose=True)
 
-    def search(self, q: str, overrides: dict) -> str:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+    async def search(self, q: str, overrides: dict) -> tuple[list[str], str]:
+        with metrics.timer("approach_stage_seconds", approach=self.name, stage="search"):
+            docs = await self.retriever.search(q, overrides)
+        results = format_sources(self.name, docs, overrides, self.sources_token_budget, self.source_token_limit, separator=":")
+        return results, "\n".join(results)
 
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
-        else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
-        return "\n".join(self.results)
+    async def lookup(self, q: str) -> str:
+        return await self.retriever.policy.call(lambda: self.lookup_answer(q), "search", self.retriever.timeout, kind="lookup")
 
-    def lookup(self, q: str) -> str:
-        r = self.search_client.search(q,
+    async def lookup_answer(self, q: str) -> str:
+        r = await self.retriever.search_client.search(q,
                                       top = 1,
                                       include_total_count=True,
                                       query_type=QueryType.SEMANTIC, 
@@ -53,48 +62,40 @@ class ReadDecomposeAsk(Approach):
                                       query_answer="extractive|count-1",
                                       query_caption="extractive|highlight-false")
         
-        answers = r.get_answers()
+        answers = await r.get_answers()
         if answers and len(answers) > 0:
             return answers[0].text
-        if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
+        if await r.get_count() > 0:
+            return "\n".join([d['content'] async for d in r])
         return None        
 
-    def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
+    # Keep the results of the last search with the request, requests are interleaved when running async
+    async def search_and_store(self, q: str) -> any:
+        state = request_state.get()
+        state["results"], content = await self.search(q, state["overrides"])
+        return content
 
+    async def run(self, q: str, overrides: dict) -> any:
         # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+        cb_handler = TraceCallbackHandler()
+        metrics_handler = MetricsCallbackHandler(self.name)
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides), description="useful for when you need to ask with search", callbacks=cb_manager),
-            Tool(name="Lookup", func=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
-        ]
-
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
-        prompt_prefix = overrides.get("prompt_template")
-        prompt = PromptTemplate.from_examples(
-            EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
-
-        agent = ReAct.from_llm_and_tools(llm, tools)
-        chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        chain = self.get_agent(0.3 if overrides.get("temperature") is None else overrides["temperature"], overrides.get("prompt_template"))
+        state = {"overrides": overrides, "results": None}
+        token = request_state.set(state)
+        try:
+            with metrics.timer("approach_stage_seconds", approach=self.name, stage="agent"):
+                result = await arun_within_deadline(chain, q, [cb_handler, metrics_handler], self.name)
+        finally:
+            request_state.reset(token)
+        metrics_handler.record_run()
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid 
         # generalizing too much and disrupt HTML snippets if present
         result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
-    
-class ReAct(ReActDocstoreAgent):
-    @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
-    
+        return {"data_points": state["results"] or [], "answer": result, "trace": cb_handler.trace}
+
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
     """Question: What is the elevation range for the area that the eastern sector of the
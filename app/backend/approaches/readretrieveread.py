@@ -1,15 +1,19 @@
-import openai
+import functools
+import metrics
+from contextvars import ContextVar
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from langchain.llms.openai import AzureOpenAI
-from langchain.callbacks.manager import CallbackManager, Callbacks
+from langchain.callbacks.manager import Callbacks
 from langchain.chains import LLMChain
 from langchain.agents import Tool, ZeroShotAgent, AgentExecutor
-from langchain.llms.openai import AzureOpenAI
-from langchainadapters import HtmlCallbackHandler
-from text import nonewlines
+from langchainadapters import TraceCallbackHandler, MetricsCallbackHandler, arun_within_deadline
+from llm import agent_llm
 from lookuptool import CsvLookupTool
+from retrieval import Retriever
+from sources import format_sources
+
+# Overrides and search results of the request being answered, set around each agent run. Every request runs in its own
+# task (or thread), each with its own context, so the shared tools see the state of the request that called them
+request_state = ContextVar("rrr_request_state")
 
 # Attempt to answer questions by iteratively evaluating the question to see what information is missing, and once all information
 # is present then formulate an answer. Each iteration consists of two parts: first use GPT to see if we need more information, 
@@ -17,6 +21,7 @@ from lookuptool import CsvLookupTool
 # This is inspired by the MKRL paper[1] and applied here using the implementation in Langchain.
 # [1] E. Karpas, et al. arXiv:2205.00445
 class ReadRetrieveReadApproach(Approach):
+    name = "rrr"
 
     template_prefix = \
 "You are an intelligent assistant helping Contoso Inc employees with their healthcare plan questions and employee handbook questions. " \
@@ -39,69 +44,72 @@ Thought: {agent_scratchpad}"""
 
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Tokens for the sources in each search observation, and for each source in it. Observations pile up in the prompt 
+    # with every iteration, so sources are kept short
+    sources_token_budget = 640
+    source_token_limit = 64
+
+    def __init__(self, retriever: Retriever, openai_deployment: str):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
-
-    def retrieve(self, q: str, overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q,
-                                          filter=filter, 
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        content = "\n".join(self.results)
+        # Tools and agents are shared by all requests, what's specific to a request is in request_state and in the 
+        # callbacks passed to each run. Agents are built once for each temperature and prompt, the default one right away
+        self.tools = [
+            Tool(name="CognitiveSearch", 
+                 func=lambda _: "Not implemented", 
+                 coroutine=self.retrieve_and_store,
+                 description=self.CognitiveSearchToolDescription),
+            EmployeeInfoTool("Employee1")]
+        self.get_agent = functools.lru_cache(maxsize=16)(self.create_agent)
+        self.get_agent(0.3, None, None)
+
+    def create_agent(self, temperature: float, prefix: str, suffix: str) -> AgentExecutor:
+        prompt = ZeroShotAgent.create_prompt(
+            tools=self.tools,
+            prefix=prefix or self.template_prefix,
+            suffix=suffix or self.template_suffix,
+            input_variables = ["input", "agent_scratchpad"])
+        chain = LLMChain(llm = agent_llm(self.name, self.openai_deployment, temperature), prompt = prompt)
+        return AgentExecutor.from_agent_and_tools(
+            agent = ZeroShotAgent(llm_chain = chain, tools = self.tools),
+            tools = self.tools, 
+            verbose = True)
+
+    async def retrieve(self, q: str, overrides: dict) -> tuple[list[str], str]:
+        with metrics.timer("approach_stage_seconds", approach=self.name, stage="search"):
+            docs = await self.retriever.search(q, overrides)
+        results = format_sources(self.name, docs, overrides, self.sources_token_budget, self.source_token_limit, separator=":", caption_separator=" -.- ")
+        content = "\n".join(results)
+        return results, content
+
+    # Keep the results of the last search with the request, requests are interleaved when running async
+    async def retrieve_and_store(self, q: str) -> any:
+        state = request_state.get()
+        state["results"], content = await self.retrieve(q, state["overrides"])
         return content
         
-    def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
-
+    async def run(self, q: str, overrides: dict) -> any:
         # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-        
-        acs_tool = Tool(name="CognitiveSearch", 
-                        func=lambda q: self.retrieve(q, overrides), 
-                        description=self.CognitiveSearchToolDescription,
-                        callbacks=cb_manager)
-        employee_tool = EmployeeInfoTool("Employee1", callbacks=cb_manager)
-        tools = [acs_tool, employee_tool]
+        cb_handler = TraceCallbackHandler()
+        metrics_handler = MetricsCallbackHandler(self.name)
 
-        prompt = ZeroShotAgent.create_prompt(
-            tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
-            input_variables = ["input", "agent_scratchpad"])
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
-        chain = LLMChain(llm = llm, prompt = prompt)
-        agent_exec = AgentExecutor.from_agent_and_tools(
-            agent = ZeroShotAgent(llm_chain = chain, tools = tools),
-            tools = tools, 
-            verbose = True, 
-            callback_manager = cb_manager)
-        result = agent_exec.run(q)
+        agent_exec = self.get_agent(
+            0.3 if overrides.get("temperature") is None else overrides["temperature"],
+            overrides.get("prompt_template_prefix"),
+            overrides.get("prompt_template_suffix"))
+        state = {"overrides": overrides, "results": None}
+        token = request_state.set(state)
+        try:
+            with metrics.timer("approach_stage_seconds", approach=self.name, stage="agent"):
+                result = await arun_within_deadline(agent_exec, q, [cb_handler, metrics_handler], self.name)
+        finally:
+            request_state.reset(token)
+        metrics_handler.record_run()
                 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": state["results"] or [], "answer": result, "trace": cb_handler.trace}
 
 class EmployeeInfoTool(CsvLookupTool):
     employee_name: str = ""
@@ -112,8 +120,9 @@ class EmployeeInfoTool(CsvLookupTool):
                          name="Employee", 
                          description="useful for answering questions about the employee, their benefits and other personal information",
                          callbacks=callbacks)
-        self.func = self.employee_info
+        self.func = lambda _: "Not implemented"
+        self.coroutine = self.employee_info
         self.employee_name = employee_name
 
-    def employee_info(self, unused: str) -> str:
-        return self.lookup(self.employee_name)
+    async def employee_info(self, unused: str) -> str:
+        return await self.alookup(self.employee_name)
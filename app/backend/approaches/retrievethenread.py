@@ -1,13 +1,15 @@
-import openai
+import llm
+import metrics
 from approaches.approach import Approach
-from azure.search.documents import SearchClient
-from azure.search.documents.models import QueryType
-from text import nonewlines
+from retrieval import Retriever
+from sources import format_sources
+from typing import AsyncGenerator
 
 # Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
 # top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion 
 # (answer) with that prompt.
 class RetrieveThenReadApproach(Approach):
+    name = "rtr"
 
     template = \
 "You are an intelligent assistant helping Contoso Inc employees with their healthcare plan questions and employee handbook questions. " + \
@@ -39,42 +41,46 @@ Sources:
 Answer:
 """
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
-        self.search_client = search_client
+    # Prompt tokens for the sources, filled with the top ranked ones
+    sources_token_budget = 1500
+
+    def __init__(self, retriever: Retriever, openai_deployment: str):
+        self.retriever = retriever
         self.openai_deployment = openai_deployment
-        self.sourcepage_field = sourcepage_field
-        self.content_field = content_field
-
-    def run(self, q: str, overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
-        else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+
+    async def run(self, q: str, overrides: dict) -> any:
+        results, prompt = await self.retrieve_and_build_prompt(q, overrides)
+        completion = await llm.complete(self.name, "answer", **self.completion_args(prompt, overrides))
+
+        return {"data_points": results, "answer": completion.choices[0].text, "trace": self.trace(q, prompt)}
+
+    async def run_stream(self, q: str, overrides: dict) -> AsyncGenerator[dict, None]:
+        results, prompt = await self.retrieve_and_build_prompt(q, overrides)
+        yield {"data_points": results}
+
+        async for chunk in llm.stream(self.name, "answer", **self.completion_args(prompt, overrides)):
+            if chunk.choices and chunk.choices[0].text:
+                yield {"answer": chunk.choices[0].text}
+
+        yield {"trace": self.trace(q, prompt)}
+
+    async def retrieve_and_build_prompt(self, q: str, overrides: dict) -> tuple[list[str], str]:
+        with metrics.timer("approach_stage_seconds", approach=self.name, stage="search"):
+            docs = await self.retriever.search(q, overrides)
+        results = format_sources(self.name, docs, overrides, self.sources_token_budget)
         content = "\n".join(results)
 
         prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
-        completion = openai.Completion.create(
-            engine=self.openai_deployment, 
-            prompt=prompt, 
-            temperature=overrides.get("temperature") or 0.3, 
-            max_tokens=1024, 
-            n=1, 
-            stop=["\n"])
-
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        return results, prompt
+
+    def completion_args(self, prompt: str, overrides: dict) -> dict:
+        return {
+            "engine": self.openai_deployment, 
+            "prompt": prompt, 
+            "temperature": 0.3 if overrides.get("temperature") is None else overrides["temperature"], 
+            "max_tokens": 1024, 
+            "n": 1, 
+            "stop": ["\n"]}
+
+    def trace(self, q: str, prompt: str) -> list[dict]:
+        return [{"type": "question", "text": q}, {"type": "prompt", "text": prompt}]
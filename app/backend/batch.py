@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import app as appmodule
+import llm
+from approaches.retrievethenread import RetrieveThenReadApproach
+from text import normalize
+
+# Answers a file of questions offline with any of the /ask approaches, with the same configuration (environment
+# variables) as the app. Run it from app/backend:
+#   python batch.py questions.jsonl --output answers.jsonl --approach rtr --concurrency 16
+# Each input line is a JSON object with a "question" and optionally "id", "approach" and "overrides" (which take
+# precedence over --approach and --overrides), or just a question as a JSON string. Questions that are the same once
+# normalized, with the same approach and overrides, are answered once. Answers are written as they complete, one JSON
+# object per line with the input's id and line number, and the seconds each stage took
+
+def read_items(filename: str, approach: str, overrides: dict) -> list[dict]:
+    items = []
+    with open(filename, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            items.append({"id": item.get("id", line_number),
+                          "line": line_number,
+                          "question": item["question"],
+                          "approach": item.get("approach") or approach,
+                          "overrides": {**overrides, **(item.get("overrides") or {})}})
+    return items
+
+def item_key(item: dict) -> tuple:
+    return (item["approach"], normalize(item["question"]), json.dumps({k: v for k, v in item["overrides"].items() if v is not None}, sort_keys=True))
+
+# Retrieve-then-read makes a single completion per question, so its completions are grouped into multi-prompt requests
+async def run_batched(impl: RetrieveThenReadApproach, batcher: llm.CompletionBatcher, q: str, overrides: dict) -> tuple[dict, dict]:
+    start = time.monotonic()
+    results, prompt = await impl.retrieve_and_build_prompt(q, overrides)
+    searched = time.monotonic()
+    completion = await batcher.complete(impl.name, "answer", **impl.completion_args(prompt, overrides))
+    timings = {"search": round(searched - start, 3), "answer": round(time.monotonic() - searched, 3)}
+    return {"data_points": results, "answer": completion.choices[0].text, "trace": impl.trace(q, prompt)}, timings
+
+async def answer(item: dict, batcher: llm.CompletionBatcher, concurrency: asyncio.Semaphore) -> dict:
+    impl = appmodule.ask_approaches.get(item["approach"])
+    if not impl:
+        return {"error": f"unknown approach '{item['approach']}'"}
+    async with concurrency:
+        await appmodule.ensure_openai_token()
+        start = time.monotonic()
+        try:
+            if isinstance(impl, RetrieveThenReadApproach) and batcher:
+                r, timings = await run_batched(impl, batcher, item["question"], item["overrides"])
+            else:
+                r, timings = await impl.run(item["question"], item["overrides"]), {}
+        except Exception as e:
+            logging.exception(f"Exception answering '{item['question']}'")
+            return {"error": str(e), "seconds": {"total": round(time.monotonic() - start, 3)}}
+        return {**r, "seconds": {**timings, "total": round(time.monotonic() - start, 3)}}
+
+async def main(args: argparse.Namespace) -> int:
+    items = read_items(args.questions, args.approach, json.loads(args.overrides))
+    unique = {}
+    for item in items:
+        unique.setdefault(item_key(item), []).append(item)
+    print(f"{len(items)} questions, {len(unique)} distinct", file=sys.stderr)
+
+    batcher = llm.CompletionBatcher(args.batch_size, args.batch_wait) if args.batch_size > 1 else None
+    concurrency = asyncio.Semaphore(args.concurrency)
+    # Questions wait for the OpenAI quota however long it takes, there's no user to answer quickly
+    llm.admission.max_wait = float("inf")
+    await appmodule.setup_clients()
+    errors = 0
+    start = time.monotonic()
+    try:
+        async def answer_group(group: list[dict]) -> tuple[list[dict], dict]:
+            return group, await answer(group[0], batcher, concurrency)
+
+        with open(args.output, "w", encoding="utf-8") as output:
+            for done, next_answer in enumerate(asyncio.as_completed([answer_group(group) for group in unique.values()]), 1):
+                group, r = await next_answer
+                errors += "error" in r
+                if not args.thoughts:
+                    r = {k: v for k, v in r.items() if k != "trace"}
+                for item in group:
+                    fields = {"id": item["id"], "line": item["line"], "question": item["question"], "approach": item["approach"]}
+                    output.write(json.dumps({**fields, **r}, ensure_ascii=False) + "\n")
+                output.flush()
+                if args.verbose: print(f"{done}/{len(unique)} answered", file=sys.stderr)
+    finally:
+        await appmodule.close_clients()
+
+    print(f"Answered {len(unique) - errors} of {len(unique)} distinct questions in {time.monotonic() - start:.1f}s, {errors} errors", file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Answer a file of questions with one of the /ask approaches and write the answers as JSON lines.",
+        epilog="Example: python batch.py questions.jsonl --output answers.jsonl --approach rtr --overrides '{\"temperature\": 0}'")
+    parser.add_argument("questions", help="JSON lines file of questions")
+    parser.add_argument("--output", required=True, help="JSON lines file to write the answers to")
+    parser.add_argument("--approach", default="rtr", help=f"Approach for questions that don't set one, from: {', '.join(appmodule.ask_approaches)}")
+    parser.add_argument("--overrides", default="{}", help="Overrides (JSON) for questions that don't set them")
+    parser.add_argument("--concurrency", type=int, default=16, help="Questions answered at the same time")
+    parser.add_argument("--batch-size", type=int, default=8, help="Prompts per completion request for the rtr approach, 1 to send them one by one")
+    parser.add_argument("--batch-wait", type=float, default=0.05, help="Seconds to wait for a batch of prompts to fill up")
+    parser.add_argument("--thoughts", action="store_true", help="Include the trace of the thought process (prompts, agent steps) in the output")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,161 @@
+import asyncio
+import random
+import zlib
+from azure.core.exceptions import HttpResponseError
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator
+from openai import error as openai_error
+from openai.openai_object import OpenAIObject
+
+# Local stand-ins for Cognitive Search, Blob Storage and the OpenAI completions endpoint, with configurable latency and
+# response sizes, so the app can be benchmarked without any Azure service
+
+@dataclass
+class FakeSettings:
+    search_latency: float = 0.05
+    content_size: int = 1000
+    llm_latency: float = 0.3
+    llm_token_latency: float = 0.002
+    completion_tokens: int = 100
+    jitter: float = 0.1
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_factor: float = 10.0
+
+    # Latencies vary by +/- jitter (a fraction of the latency) around the configured value, and a slow_rate share of the
+    # calls take slow_factor times longer, like a slow replica would
+    async def sleep(self, seconds: float):
+        if random.random() < self.slow_rate:
+            seconds *= self.slow_factor
+        await asyncio.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    # An error_rate share of the calls fail like a throttled (429) or unavailable (503) service would
+    def failed(self) -> bool:
+        return random.random() < self.error_rate
+
+def search_error() -> HttpResponseError:
+    e = HttpResponseError(message="Service unavailable")
+    e.status_code = 503
+    return e
+
+def completion_error() -> openai_error.OpenAIError:
+    if random.random() < 0.5:
+        return openai_error.RateLimitError("Requests are being throttled", http_status=429, headers={"retry-after-ms": "100"})
+    return openai_error.ServiceUnavailableError("The server is overloaded", http_status=503)
+
+WORDS = "deductible in-network out-of-network premium copay coinsurance plan employee family coverage claim provider " \
+        "prescription vision dental benefit wellness reimbursement eligibility enrollment policy".split()
+
+def stable_hash(s: str) -> int:
+    return zlib.crc32(s.encode("utf-8"))
+
+def words(count: int, seed: str) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+def text_of_size(size: int, seed: str) -> str:
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)[:size]
+
+class FakeCaption:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeSearchResults:
+    def __init__(self, docs: list[dict], answers: list = None):
+        self.docs = docs
+        self.answers = answers
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.docs:
+            yield doc
+
+    async def get_count(self) -> int:
+        return len(self.docs)
+
+    async def get_answers(self) -> list:
+        return self.answers
+
+class FakeSearchClient:
+    def __init__(self, settings: FakeSettings):
+        self.settings = settings
+
+    async def search(self, q: str, top: int = None, **kwargs: Any) -> FakeSearchResults:
+        await self.settings.sleep(self.settings.search_latency)
+        if self.settings.failed():
+            raise search_error()
+        docs = []
+        for i in range(top or 3):
+            # A handful of files with a few pages each, so results from the same file show up together
+            file = f"benefits{stable_hash(q + str(i)) % 5}.pdf"
+            page = stable_hash(q) % 10 + i
+            content = text_of_size(self.settings.content_size, f"{file}-{page}")
+            docs.append({"id": f"{file}-{page}",
+                         "content": content,
+                         "category": None,
+                         "sourcepage": f"{file[:-4]}-{page}.pdf",
+                         "sourcefile": file,
+                         "@search.captions": [FakeCaption(content[:200])]})
+        return FakeSearchResults(docs)
+
+    async def close(self):
+        pass
+
+class FakeContainerProperties:
+    metadata = {}
+
+class FakeBlobContainer:
+    async def get_container_properties(self) -> FakeContainerProperties:
+        return FakeContainerProperties()
+
+class FakeCompletions:
+    def __init__(self, settings: FakeSettings):
+        self.settings = settings
+
+    # Same signature as openai.Completion.acreate, answers every kind of prompt the approaches send
+    async def acreate(self, prompt: Any = None, stream: bool = False, max_tokens: int = None, **kwargs: Any) -> Any:
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        texts = [self.reply(p, max_tokens) for p in prompts]
+        await self.settings.sleep(self.settings.llm_latency)
+        if self.settings.failed():
+            raise completion_error()
+        if stream:
+            return self.stream(texts[0])
+        await self.settings.sleep(self.settings.llm_token_latency * max(len(t.split()) for t in texts))
+        return OpenAIObject.construct_from({
+            "choices": [{"text": t, "index": i, "finish_reason": "stop"} for i, t in enumerate(texts)],
+            "usage": {"prompt_tokens": sum(len(p.split()) for p in prompts),
+                      "completion_tokens": sum(len(t.split()) for t in texts),
+                      "total_tokens": sum(len(p.split()) for p in prompts) + sum(len(t.split()) for t in texts)}})
+
+    async def stream(self, text: str) -> AsyncGenerator[OpenAIObject, None]:
+        for word in text.split(" "):
+            await asyncio.sleep(self.settings.llm_token_latency)
+            yield OpenAIObject.construct_from({"choices": [{"text": word + " ", "index": 0, "finish_reason": None}]})
+
+    def reply(self, prompt: str, max_tokens: int = None) -> str:
+        answer = words(self.settings.completion_tokens, prompt[-100:])
+        query = words(4, prompt.rsplit("Question:", 1)[-1][:200])
+        if "Action Input" in prompt:
+            # ReadRetrieveReadApproach (MRKL agent): search once, then answer
+            if "Observation" in prompt.rsplit("Question:", 1)[1]:
+                return f" I now know the final answer\nFinal Answer: {answer} [benefits0-1.pdf]"
+            return f" I need to search for this\nAction: CognitiveSearch\nAction Input: {query}"
+        if "Finish[" in prompt:
+            # ReadDecomposeAsk (ReAct agent): search once, then finish
+            if "Observation" in prompt.rsplit("Question:", 1)[1]:
+                return f" I can answer now.\nAction: Finish[{answer} <benefits0-1.pdf>]"
+            return f" I need to search for this.\nAction: Search[{query}]"
+        if prompt.rstrip().endswith("Search query:"):
+            # Different questions get different queries, so the search cache only helps with repeated questions
+            return words(4, prompt[-200:])
+        return " ".join(answer.split()[:max_tokens]) if max_tokens else answer
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import openai
+import llm
+import metrics
+import app as appmodule
+from benchmarks.fakes import FakeBlobContainer, FakeCompletions, FakeSearchClient, FakeSettings
+
+# Benchmarks /ask and /chat in-process against local fakes of Cognitive Search, Blob Storage and OpenAI. Run it from
+# app/backend, for example:
+#   python -m benchmarks.run --concurrency 1,8,32 --requests 200 --save benchmarks/baselines/default.json
+#   python -m benchmarks.run --compare benchmarks/baselines/default.json
+# Latencies and response sizes of the fakes are set with the options below, baselines record them along with the results
+# and comparing against a baseline uses the baseline's settings, so the numbers stay comparable. --error-rate and 
+# --slow-rate inject failures and slow calls to see how retries, hedging (HEDGE_PERCENTILE) and the circuit breakers do.
+# benchmarks/baselines/default.json is the baseline of the app as it was when this harness was added, recorded with the
+# first command above
+
+SCENARIOS = {
+    "ask-rtr": ("/ask", "rtr", False),
+    "ask-rrr": ("/ask", "rrr", False),
+    "ask-rda": ("/ask", "rda", False),
+    "chat-rrr": ("/chat", "rrr", False),
+    "ask-rtr-stream": ("/ask", "rtr", True),
+    "chat-rrr-stream": ("/chat", "rrr", True),
+}
+
+class FakeToken:
+    token = "benchmark"
+    expires_on = 2**62
+
+def install_fakes(settings: FakeSettings):
+    appmodule.retriever.search_client = FakeSearchClient(settings)
+    appmodule.retriever.index_version.blob_container = FakeBlobContainer()
+    appmodule.openai_token = FakeToken()
+    openai.api_key = FakeToken.token
+    openai.Completion.acreate = FakeCompletions(settings).acreate
+
+def reset_state():
+    # Every scenario starts with empty caches and metrics
+    appmodule.retriever.cache.clear()
+    appmodule.answer_cache.clear()
+    for impl in appmodule.chat_approaches.values():
+        impl.query_cache.clear()
+    for policy in (appmodule.retriever.policy, llm.policy):
+        policy.latencies.clear()
+        policy.breaker.success()
+    metrics.counters.clear()
+    metrics.histograms.clear()
+
+def make_request(route: str, approach: str, stream: bool, i: int, distinct_questions: int) -> dict:
+    n = i % distinct_questions if distinct_questions else i
+    question = f"What is the deductible for the employee plan, case {n}?"
+    if route == "/ask":
+        return {"approach": approach, "question": question, "overrides": {}, "stream": stream}
+    history = [{"user": "What plans are available?", "bot": "There are two plans, Northwind Standard and Northwind Health Plus [info1.pdf]."},
+               {"user": "Which one covers vision?", "bot": "Northwind Health Plus covers vision [info2.pdf]."},
+               {"user": question}]
+    return {"approach": approach, "history": history, "overrides": {}, "stream": stream}
+
+def percentile(values: list[float], p: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+def stage_breakdown() -> dict:
+    # Mean duration (ms) per stage and per kind of completion call, from the app's own metrics
+    stages = {}
+    for (name, labels), (_, total, count) in metrics.histograms.items():
+        if name in ("approach_stage_seconds", "llm_seconds") and count:
+            stage = dict(labels)["stage"]
+            stages[("llm/" if name == "llm_seconds" else "") + stage] = round(total / count * 1000, 1)
+    return stages
+
+def resilience_counts() -> dict:
+    # Retries, hedges and calls failed fast per dependency, e.g. "openai/retries"
+    names = {"dependency_retries_total": "retries", "dependency_hedges_total": "hedges", "dependency_hedge_wins_total": "hedge_wins",
+             "circuit_breaker_rejected_total": "rejected"}
+    counts = {}
+    for (name, labels), value in metrics.counters.items():
+        if name in names:
+            key = f"{dict(labels)['dependency']}/{names[name]}"
+            counts[key] = counts.get(key, 0) + int(value)
+    return counts
+
+async def run_scenario(client, route: str, approach: str, stream: bool, concurrency: int, requests: int, distinct_questions: int) -> dict:
+    reset_state()
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < requests:
+            i = next_request
+            next_request += 1
+            start = time.perf_counter()
+            response = await client.post(route, json=make_request(route, approach, stream, i, distinct_questions))
+            body = await response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200 or (stream and b'"error"' in body):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    return {"p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "rps": round(requests / elapsed, 2),
+            "errors": errors,
+            "stages_ms": stage_breakdown(),
+            "resilience": resilience_counts()}
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: rps {base['rps']} -> {result['rps']}")
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{key}: errors {base['errors']} -> {result['errors']}")
+    return regressions
+
+async def main(args: argparse.Namespace) -> int:
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        settings = FakeSettings(**baseline["settings"])
+        config = baseline["config"]
+    else:
+        settings = FakeSettings(search_latency=args.search_latency,
+                                content_size=args.content_size,
+                                llm_latency=args.llm_latency,
+                                llm_token_latency=args.llm_token_latency,
+                                completion_tokens=args.completion_tokens,
+                                jitter=args.jitter,
+                                error_rate=args.error_rate,
+                                slow_rate=args.slow_rate,
+                                slow_factor=args.slow_factor)
+        config = {"scenarios": args.scenarios.split(","),
+                  "concurrency": [int(c) for c in args.concurrency.split(",")],
+                  "requests": args.requests,
+                  "distinct_questions": args.distinct_questions}
+    install_fakes(settings)
+
+    # The test client calls the app directly, without before/after serving (no token to get, no clients to close)
+    client = appmodule.app.test_client()
+    results = {}
+    print(f"{'scenario':<20}{'concurrency':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}  stages (mean ms), retries and hedges")
+    for name in config["scenarios"]:
+        route, approach, stream = SCENARIOS[name]
+        for concurrency in config["concurrency"]:
+            # The agents are verbose, keep their output out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                r = await run_scenario(client, route, approach, stream, concurrency, config["requests"], config["distinct_questions"])
+            results[f"{name}@{concurrency}"] = r
+            stages = ", ".join(f"{k}={v}" for k, v in {**r["stages_ms"], **r["resilience"]}.items())
+            print(f"{name:<20}{concurrency:>12}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['rps']:>10}{r['errors']:>8}  {stages}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"settings": settings.__dict__, "config": config, "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark /ask and /chat against local fakes of the Azure services.",
+        epilog="Example: python -m benchmarks.run --concurrency 1,8,32 --save benchmarks/baselines/default.json")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated scenarios, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated numbers of concurrent clients")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level")
+    parser.add_argument("--distinct-questions", type=int, default=0, help="Cycle through this many questions to exercise the caches, 0 for all different")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="Seconds per search")
+    parser.add_argument("--content-size", type=int, default=1000, help="Characters of content per search result")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds before a completion starts")
+    parser.add_argument("--llm-token-latency", type=float, default=0.002, help="Seconds per generated token")
+    parser.add_argument("--completion-tokens", type=int, default=100, help="Tokens per answer")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Latencies vary by this fraction around their value")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of searches and completions that fail with a 429 or 503")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of searches and completions that are slow")
+    parser.add_argument("--slow-factor", type=float, default=10.0, help="How many times slower the slow calls are")
+    parser.add_argument("--save", help="Save the results as a baseline to this JSON file")
+    parser.add_argument("--compare", help="Compare with a saved baseline, using its settings, and exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown when comparing with a baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,59 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+# Size bounded cache that evicts the least recently used entries first, and where entries also expire ttl seconds
+# after they were set. Not thread safe, it's meant to be used from the event loop of the app
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+# Runs at most one instance of a coroutine per key at a time, callers that ask for a key that's already in flight wait 
+# for that one to finish and all get its result (or its exception)
+class Coalescer:
+    def __init__(self):
+        self.in_flight = {}
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self.in_flight
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.finished(key, task))
+        # A caller that goes away (e.g. the client disconnected) must not cancel the work the other callers are waiting on
+        return await asyncio.shield(task)
+
+    def finished(self, key: Hashable, task: asyncio.Future):
+        self.in_flight.pop(key, None)
+        # Callers still waiting get the exception through shield(), but all of them may be gone (e.g. timed out)
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+import metrics
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator, Optional
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob.aio import BlobClient, ContainerClient
+from quart import Request, Response
+from quart.wrappers.response import ResponseBody
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable
+from cache import Coalescer
+
+metrics.describe("content_cache_hits_total", "Content files served from the local disk cache")
+metrics.describe("content_cache_misses_total", "Content files downloaded from blob storage")
+metrics.describe("content_streamed_total", "Content files streamed from blob storage without caching (too large, or gone from the cache)")
+
+# Resolves a requested byte range against the size of the content, suffix ranges ("bytes=-500") come with a negative begin
+def resolve_range(begin: int, end: Optional[int], size: int) -> tuple[int, int]:
+    if begin < 0:
+        begin = max(size + begin, 0)
+    end = size if end is None else min(end, size)
+    if begin >= end:
+        raise RequestedRangeNotSatisfiable(size)
+    return begin, end
+
+# Response body that streams a blob, or a range of it, from storage chunk by chunk
+class BlobBody(ResponseBody):
+    def __init__(self, blob_client: BlobClient, size: int):
+        self.blob_client = blob_client
+        self.size = size
+        self.begin = 0
+        self.end = size
+
+    async def __aenter__(self) -> "BlobBody":
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb) -> None:
+        pass
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.chunks()
+
+    def close(self):
+        pass
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        if self.end > self.begin:
+            downloader = await self.blob_client.download_blob(offset=self.begin, length=self.end - self.begin)
+            async for chunk in downloader.chunks():
+                yield chunk
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        self.begin, self.end = resolve_range(begin, end, self.size)
+        return self.size
+
+# Response body for a file in the local cache. The file is opened right away, so it can still be sent if it's evicted
+# from the cache before the response goes out
+class CachedFileBody(ResponseBody):
+    buffer_size = 64 * 1024
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.begin = 0
+        self.end = self.size
+
+    async def __aenter__(self) -> "CachedFileBody":
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb) -> None:
+        self.file.close()
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.chunks()
+
+    def close(self):
+        self.file.close()
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        position = self.begin
+        while position < self.end:
+            chunk = await asyncio.to_thread(os.pread, self.file.fileno(), min(self.buffer_size, self.end - position), position)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        self.begin, self.end = resolve_range(begin, end, self.size)
+        return self.size
+
+@dataclass
+class ContentEntry:
+    etag: str
+    last_modified: datetime
+    content_type: str
+    size: int
+    path: Optional[str]
+    checked: float
+
+# Serves files from the blob container, streamed and with support for range and conditional requests. Blobs up to
+# max_cached_size bytes (the PDF pages the citations point to) are kept in a local disk cache of up to cache_size bytes,
+# and are only checked against storage again after revalidate_interval seconds. Each process has its own cache directory,
+# created on first use and removed by close(). Entries are pinned while a request waits on storage to serve them, so
+# other requests' downloads don't evict them in the meantime
+class ContentStore:
+    def __init__(self, blob_container: ContainerClient, cache_size: int, max_cached_size: int, revalidate_interval: float,
+                 cache_dir: str = None):
+        self.blob_container = blob_container
+        self.cache_size = cache_size
+        self.max_cached_size = max_cached_size
+        self.revalidate_interval = revalidate_interval
+        self.cache_dir = cache_dir
+        self.directory = None
+        self.entries = OrderedDict()
+        self.cached_bytes = 0
+        self.downloads = Coalescer()
+        self.pins = Counter()
+
+    async def get_response(self, name: str, request: Request) -> Response:
+        entry = self.entries.get(name)
+        if entry is not None and time.monotonic() - entry.checked < self.revalidate_interval:
+            self.entries.move_to_end(name)
+            metrics.inc("content_cache_hits_total")
+            return await self.make_response(name, CachedFileBody(entry.path), entry, request)
+
+        self.pins[name] += 1
+        try:
+            return await self.get_checked_response(name, request)
+        finally:
+            self.pins[name] -= 1
+            if not self.pins[name]:
+                del self.pins[name]
+
+    async def get_checked_response(self, name: str, request: Request) -> Response:
+        blob_client = self.blob_container.get_blob_client(name)
+        try:
+            properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            self.evict(name)
+            raise NotFound()
+        content_type = properties.content_settings.content_type
+        if not content_type or content_type == "application/octet-stream":
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        # The entry may have been replaced or evicted while the properties were read
+        entry = self.entries.get(name)
+        if entry is not None and entry.etag == properties.etag:
+            entry.checked = time.monotonic()
+            self.entries.move_to_end(name)
+            metrics.inc("content_cache_hits_total")
+            return await self.make_response(name, self.open_cached(blob_client, entry), entry, request)
+
+        entry = ContentEntry(properties.etag, properties.last_modified, content_type, properties.size, None, time.monotonic())
+        if properties.size > self.max_cached_size:
+            metrics.inc("content_streamed_total")
+            return await self.make_response(name, BlobBody(blob_client, properties.size), entry, request)
+
+        metrics.inc("content_cache_misses_total")
+        entry = await self.downloads.run((name, entry.etag), lambda: self.download(name, blob_client, entry))
+        return await self.make_response(name, self.open_cached(blob_client, entry), entry, request)
+
+    # Pinned entries aren't evicted, but the cache may still have been closed, then the blob is streamed from storage
+    def open_cached(self, blob_client: BlobClient, entry: ContentEntry) -> ResponseBody:
+        try:
+            return CachedFileBody(entry.path)
+        except FileNotFoundError:
+            metrics.inc("content_streamed_total")
+            return BlobBody(blob_client, entry.size)
+
+    async def download(self, name: str, blob_client: BlobClient, entry: ContentEntry) -> ContentEntry:
+        downloader = await blob_client.download_blob()
+        data = await downloader.readall()
+        # The blob may have changed since its properties were read, describe what was actually downloaded
+        entry.etag = downloader.properties.etag
+        entry.last_modified = downloader.properties.last_modified
+        entry.size = len(data)
+
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="content-", dir=self.cache_dir)
+        entry.path = os.path.join(self.directory, hashlib.sha256((name + entry.etag).encode("utf-8")).hexdigest())
+        self.evict(name)
+        await asyncio.to_thread(write_file, entry.path, data)
+
+        self.entries[name] = entry
+        self.cached_bytes += entry.size
+        # Least recently used first, skipping the entries requests are waiting to serve (this one included)
+        for evicted in [n for n in self.entries if not self.pins[n]]:
+            if self.cached_bytes <= self.cache_size:
+                break
+            self.evict(evicted)
+        return entry
+
+    def evict(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.cached_bytes -= entry.size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    async def make_response(self, name: str, body: ResponseBody, entry: ContentEntry, request: Request) -> Response:
+        response = Response(body, content_type=entry.content_type)
+        response.content_length = body.size
+        response.headers["ETag"] = entry.etag
+        response.headers["Content-Disposition"] = f"inline; filename={name}"
+        response.last_modified = entry.last_modified
+        response.accept_ranges = "bytes"
+        # Handles Range and If-Range (206, 416), and If-None-Match and If-Modified-Since (304)
+        try:
+            await response.make_conditional(request, accept_ranges=True, complete_length=body.size)
+        except Exception:
+            body.close()
+            raise
+        if response.status_code == 206:
+            # ContentRange takes an exclusive end, Quart passes the last byte instead and announces one byte short
+            response.content_range = ContentRange("bytes", body.begin, body.end, body.size)
+        # Quart reads the body even when there's nothing to send, don't download or read the content for nothing. HEAD
+        # responses keep the headers of the GET, Content-Length included (Quart's test client recomputes it from the
+        # empty body and shows 0, servers send it as set here)
+        if response.status_code in (304, 412) or request.method == "HEAD":
+            body.close()
+            response.response = response.iterable_body_class([])
+        return response
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.entries.clear()
+            self.cached_bytes = 0
+
+def write_file(path: str, data: bytes):
+    # Write next to the final path and swap it in, so readers never see a partial file
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
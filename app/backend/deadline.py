@@ -0,0 +1,90 @@
+import asyncio
+import time
+import metrics
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Optional, TypeVar
+
+T = TypeVar("T")
+
+metrics.describe("deadline_exceeded_total", "Stages that ran out of time, either the request's or their own timeout")
+
+# When the request being served must be answered by, in time.monotonic() seconds. Tasks started while serving it inherit
+# it along with the rest of the context
+current = ContextVar("deadline", default=None)
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+# Requests get a deadline when they arrive, nested scopes can only make it earlier
+@contextmanager
+def scope(seconds: Optional[float]):
+    deadline = current.get()
+    if seconds:
+        deadline = time.monotonic() + seconds if deadline is None else min(deadline, time.monotonic() + seconds)
+    token = current.set(deadline)
+    try:
+        yield
+    finally:
+        current.reset(token)
+
+# Seconds left until the deadline, None without one
+def remaining() -> Optional[float]:
+    deadline = current.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+# Waits for a stage up to its own timeout or the deadline, whichever comes first, and cancels it when time is up
+async def run(awaitable: Awaitable[T], stage: str, timeout: Optional[float] = None) -> T:
+    left = remaining()
+    if left is not None:
+        timeout = left if timeout is None else min(timeout, left)
+    if timeout is None:
+        return await awaitable
+    try:
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        return await asyncio.wait_for(awaitable, timeout)
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        metrics.inc("deadline_exceeded_total", stage=stage)
+        raise DeadlineExceeded(f"Ran out of time in {stage}")
+
+# Iterates up to the deadline, for streams of many small items. The items are read by a task of their own, cancelled when
+# time is up, so a stream costs one task and one timer instead of a wait_for (and the task it starts) per item
+async def iterate(iterator: AsyncIterator[T], stage: str) -> AsyncIterator[T]:
+    left = remaining()
+    if left is None:
+        async for item in iterator:
+            yield item
+        return
+    items = asyncio.Queue()
+    end = object()
+
+    async def read():
+        try:
+            async for item in iterator:
+                items.put_nowait((item, None))
+            items.put_nowait((end, None))
+        except BaseException as e:
+            items.put_nowait((end, e))
+
+    reader = asyncio.ensure_future(read())
+    timer = asyncio.get_running_loop().call_later(max(left, 0), reader.cancel)
+    try:
+        while True:
+            item, error = await items.get()
+            if item is not end:
+                yield item
+            elif isinstance(error, asyncio.CancelledError):
+                metrics.inc("deadline_exceeded_total", stage=stage)
+                raise DeadlineExceeded(f"Ran out of time in {stage}")
+            elif error is not None:
+                raise error
+            else:
+                return
+    finally:
+        timer.cancel()
+        reader.cancel()
@@ -0,0 +1,12 @@
+import multiprocessing
+import os
+
+# The app is asyncio-native (Quart), so run it under uvicorn workers: each worker process keeps many requests in
+# flight while they wait on Cognitive Search, Storage and OpenAI, a couple of workers per core is enough
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("WEB_CONCURRENCY") or (multiprocessing.cpu_count() * 2) + 1)
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 600
+
+# The workers inherit the environment, so each of them knows its share of the OpenAI quotas (see app.py)
+os.environ["WEB_CONCURRENCY"] = str(workers)
@@ -1,88 +1,121 @@
+import asyncio
+import time
+import deadline
+import metrics
 from typing import Any, Dict, List, Optional
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.schema import AgentAction, AgentFinish, LLMResult
-
-def ch(text: str) -> str:
-    s = text if isinstance(text, str) else str(text)
-    return s.replace("<", "&lt;").replace(">", "&gt;").replace("\r", "").replace("\n", "<br>")
-
-class HtmlCallbackHandler (BaseCallbackHandler):
-    html: str = ""
-
-    def get_and_reset_log(self) -> str:
-        result = self.html
-        self.html = ""
-        return result
-    
-    def on_llm_start(
-        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
-    ) -> None:
-        """Print out the prompts."""
-        self.html += f"LLM prompts:<br>" + "<br>".join(ch(prompts)) + "<br>";
-
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        """Do nothing."""
-        pass
+from uuid import UUID
+from langchain.agents import Agent, AgentExecutor
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.schema import AgentAction, AgentFinish, OutputParserException
+
+metrics.describe("agent_stopped_total", "Agent runs stopped early to answer within the deadline")
+
+# Records what an agent does as trace events (see thoughts.py), rendered only if the client asks for the thought process.
+# Async like the handlers below, so the events are recorded on the event loop
+class TraceCallbackHandler(AsyncCallbackHandler):
+    def __init__(self):
+        self.trace = []
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        self.trace.append({"type": "llm_start", "prompts": prompts})
+
+    async def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
+        self.trace.append({"type": "llm_error", "error": str(error)})
+
+    async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> None:
+        self.trace.append({"type": "chain_start", "name": serialized["name"]})
+
+    async def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+        self.trace.append({"type": "chain_end"})
+
+    async def on_chain_error(self, error: Exception, **kwargs: Any) -> None:
+        self.trace.append({"type": "chain_error", "error": str(error)})
+
+    async def on_tool_end(self, output: str, color: Optional[str] = None, observation_prefix: Optional[str] = None,
+                          llm_prefix: Optional[str] = None, **kwargs: Any) -> None:
+        self.trace.append({"type": "tool_end", "observation_prefix": str(observation_prefix), "output": str(output),
+                           "llm_prefix": str(llm_prefix), "color": color})
+
+    async def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
+        self.trace.append({"type": "tool_error", "error": str(error)})
+
+    async def on_text(self, text: str, color: Optional[str] = None, **kwargs: Any) -> None:
+        self.trace.append({"type": "text", "text": str(text), "color": color})
+
+    async def on_agent_action(self, action: AgentAction, color: Optional[str] = None, **kwargs: Any) -> Any:
+        self.trace.append({"type": "agent_action", "log": action.log, "color": color})
+
+    async def on_agent_finish(self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any) -> None:
+        self.trace.append({"type": "agent_finish", "log": finish.log, "color": color})
 
-    def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>LLM error: {ch(error)}</span><br>"
-
-    def on_chain_start(
-        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
-    ) -> None:
-        """Print out that we are entering a chain."""
-        class_name = serialized["name"]
-        self.html += f"Entering chain: {ch(class_name)}<br>"
-
-    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
-        """Print out that we finished a chain."""
-        self.html += f"Finished chain<br>"
-
-    def on_chain_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Chain error: {ch(error)}</span><br>"
-
-    def on_tool_start(
-        self,
-        serialized: Dict[str, Any],
-        input_str: str,
-        color: Optional[str] = None,
-        **kwargs: Any,
-    ) -> None:
-        """Print out the log in specified color."""
-        pass
 
-    def on_tool_end(
-        self,
-        output: str,
-        color: Optional[str] = None,
-        observation_prefix: Optional[str] = None,
-        llm_prefix: Optional[str] = None,
-        **kwargs: Any,
-    ) -> None:
-        """If not the final action, print out observation."""
-        self.html += f"{ch(observation_prefix)}<br><span style='color:{color}'>{ch(output)}</span><br>{ch(llm_prefix)}<br>"
-
-    def on_tool_error(self, error: Exception, **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Tool error: {ch(error)}</span><br>"
-
-    def on_text(
-        self,
-        text: str,
-        color: Optional[str] = None,
-        **kwargs: Optional[str],
-    ) -> None:
-        """Run when agent ends."""
-        self.html += f"<span style='color:{color}'>{ch(text)}</span><br>"
-
-    def on_agent_action(
-        self, 
-        action: AgentAction, 
-        color: Optional[str] = None,
-        **kwargs: Any) -> Any:
-        self.html += f"<span style='color:{color}'>{ch(action.log)}</span><br>"
-
-    def on_agent_finish(
-        self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
-    ) -> None:
-        """Run on agent end."""
-        self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+metrics.describe("agent_iterations", "Actions taken by an agent to answer a question", (1, 2, 3, 4, 5, 6, 8, 10, 15))
+metrics.describe("agent_tool_seconds", "Duration of agent tool calls")
+
+# Measures tool calls and counts the iterations of an agent run, one handler per run. It's async so LangChain calls it
+# on the event loop rather than from a thread pool
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    def __init__(self, approach: str):
+        self.approach = approach
+        self.iterations = 0
+        self.tool_starts = {}
+
+    async def on_agent_action(self, action: AgentAction, **kwargs: Any) -> None:
+        self.iterations += 1
+
+    async def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.tool_starts[run_id] = (serialized.get("name"), time.monotonic())
+
+    async def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self.tool_finished(run_id)
+
+    async def on_tool_error(self, error: Exception, *, run_id: UUID, **kwargs: Any) -> None:
+        self.tool_finished(run_id)
+
+    def tool_finished(self, run_id: UUID):
+        if run_id in self.tool_starts:
+            tool, start = self.tool_starts.pop(run_id)
+            metrics.observe("agent_tool_seconds", time.monotonic() - start, approach=self.approach, tool=tool)
+
+    def record_run(self):
+        metrics.observe("agent_iterations", self.iterations, approach=self.approach)
+
+# Keeps the actions of an agent run along with their observations, like the executor's intermediate steps
+class StepsCallbackHandler(AsyncCallbackHandler):
+    def __init__(self):
+        self.steps = []
+        self.action = None
+
+    async def on_agent_action(self, action: AgentAction, **kwargs: Any) -> None:
+        self.action = action
+
+    async def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        if self.action:
+            self.steps.append((self.action, output))
+            self.action = None
+
+# Runs an agent within the request's deadline. The agent iterates until answer_seconds are left (or half the time, for 
+# short deadlines), or until a search or completion runs out of time, and then answers from what it found so far with 
+# one more completion. This is LangChain's "generate" early stopping, which its executor only does synchronously
+async def arun_within_deadline(executor: AgentExecutor, q: str, callbacks: list, approach: str, answer_seconds: float = 10) -> str:
+    left = deadline.remaining()
+    if left is None:
+        return await executor.arun(q, callbacks=callbacks)
+    steps = StepsCallbackHandler()
+    try:
+        return await asyncio.wait_for(executor.arun(q, callbacks=callbacks + [steps]), max(left - answer_seconds, left / 2))
+    except asyncio.TimeoutError:
+        metrics.inc("agent_stopped_total", approach=approach)
+    return await agenerate_stopped_answer(executor.agent, steps.steps, q, callbacks)
+
+async def agenerate_stopped_answer(agent: Agent, steps: list, q: str, callbacks: list) -> str:
+    thoughts = "".join(f"{action.log}\n{agent.observation_prefix}{observation}\n{agent.llm_prefix}" for action, observation in steps)
+    thoughts += "\n\nI now need to return a final answer based on the previous steps:"
+    output = await agent.llm_chain.apredict(callbacks=callbacks, input=q, agent_scratchpad=thoughts, stop=agent._stop)
+    try:
+        parsed = agent.output_parser.parse(output)
+        if isinstance(parsed, AgentFinish):
+            return parsed.return_values["output"]
+    except OutputParserException:
+        pass
+    return output.strip()
@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import json
+import time
+import openai
+import deadline
+import metrics
+from admission import AdmissionController
+from resilience import Policy
+from typing import Any, AsyncGenerator
+from openai.openai_object import OpenAIObject
+from langchain.llms.openai import AzureOpenAI
+from tokens import count_prompt_tokens
+
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+metrics.describe("llm_seconds", "Duration of completion calls (until the last token for streamed ones)")
+metrics.describe("llm_first_token_seconds", "Time to the first token of streamed completions")
+metrics.describe("llm_prompt_tokens", "Prompt tokens per completion call", TOKEN_BUCKETS)
+metrics.describe("llm_completion_tokens", "Completion tokens per completion call", TOKEN_BUCKETS)
+
+# Seconds a completion may take, or until its first token for streamed ones, set by the app. The request's deadline
+# applies too, whichever comes first
+timeout = None
+
+# Retries, hedging and circuit breaking for every completion, replaced by the app with its configured policy
+policy = Policy("openai")
+
+# Queues completions under the deployments' tokens/requests per minute quotas, set by the app. Retries and hedges aren't 
+# queued again
+admission = AdmissionController({})
+
+# All completions go through here, so every call is measured the same way. approach and stage only label the metrics
+async def complete(approach: str, stage: str, **args: Any) -> OpenAIObject:
+    await admission.admit(args)
+    with metrics.timer("llm_seconds", approach=approach, stage=stage):
+        completion = await policy.call(lambda: openai.Completion.acreate(**args), "completion", timeout, kind=(approach, stage))
+    usage = completion.get("usage")
+    if usage:
+        metrics.observe("llm_prompt_tokens", usage["prompt_tokens"], approach=approach, stage=stage)
+        metrics.observe("llm_completion_tokens", usage["completion_tokens"], approach=approach, stage=stage)
+    return completion
+
+# Streamed completions don't report usage, the prompt is counted with the tokenizer and the completion by its chunks (the
+# service sends one token per chunk). Starting the stream is retried, but not hedged, and a stream that breaks off isn't retried
+async def stream(approach: str, stage: str, **args: Any) -> AsyncGenerator[OpenAIObject, None]:
+    await admission.admit(args)
+    start = time.monotonic()
+    chunks = 0
+    try:
+        chunks_iterator = await policy.call(lambda: openai.Completion.acreate(**args, stream=True), "completion", timeout, hedge=False)
+        # Closed right away when the caller stops early, so the chunks stop being read
+        async with contextlib.aclosing(deadline.iterate(chunks_iterator, "completion")) as chunks_in_time:
+            async for chunk in chunks_in_time:
+                if chunks == 0:
+                    metrics.observe("llm_first_token_seconds", time.monotonic() - start, approach=approach, stage=stage)
+                chunks += 1
+                yield chunk
+    finally:
+        metrics.observe("llm_seconds", time.monotonic() - start, approach=approach, stage=stage)
+        prompt = args.get("prompt")
+        if isinstance(prompt, str):
+            metrics.observe("llm_prompt_tokens", count_prompt_tokens(prompt), approach=approach, stage=stage)
+        metrics.observe("llm_completion_tokens", chunks, approach=approach, stage=stage)
+
+# Stand-in for openai.Completion as the client of LangChain's OpenAI LLMs, so that the completions agents make go
+# through complete() as well
+class CompletionClient:
+    def __init__(self, approach: str, stage: str):
+        self.approach = approach
+        self.stage = stage
+
+    async def acreate(self, **args: Any) -> OpenAIObject:
+        return await complete(self.approach, self.stage, **args)
+
+    def create(self, **args: Any) -> OpenAIObject:
+        return openai.Completion.create(**args)
+
+# Groups completions with the same arguments but different prompts into multi-prompt requests, of up to batch_size
+# prompts and waiting at most max_wait seconds for a batch to fill up. Only for n=1, each caller gets the choice for its prompt
+class CompletionBatcher:
+    def __init__(self, batch_size: int = 8, max_wait: float = 0.05):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = {}
+
+    async def complete(self, approach: str, stage: str, **args: Any) -> OpenAIObject:
+        key = (approach, stage, json.dumps({k: v for k, v in args.items() if k != "prompt"}, sort_keys=True))
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((args["prompt"], future))
+        if len(batch) >= self.batch_size:
+            self.flush(key, batch, approach, stage, args)
+        elif len(batch) == 1:
+            asyncio.get_running_loop().call_later(self.max_wait, self.flush, key, batch, approach, stage, args)
+        return await future
+
+    def flush(self, key: tuple, batch: list, approach: str, stage: str, args: dict):
+        # The timer of a batch that was already sent when full finds another batch (or none) under its key
+        if self.pending.get(key) is batch:
+            del self.pending[key]
+            asyncio.ensure_future(self.send(batch, approach, stage, args))
+
+    async def send(self, batch: list, approach: str, stage: str, args: dict):
+        try:
+            completion = await complete(approach, stage, **{**args, "prompt": [prompt for prompt, _ in batch]})
+            choices = {choice.index: choice for choice in completion.choices}
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(OpenAIObject.construct_from({"choices": [choices[i]]}))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+# LangChain LLM for the agents, its completions go through complete() as well. LangChain wants an API key up front (and
+# sets it as openai.api_key), but the calls use whatever openai.api_key is at the time, which the app keeps refreshed, so
+# these LLMs can be created before the first token and outlive it. complete() retries within the request's deadline, so
+# LangChain's own retries (up to 6 tries, 4-10s apart, regardless of the deadline) are turned off with max_retries=1
+def agent_llm(approach: str, deployment: str, temperature: float) -> AzureOpenAI:
+    llm = AzureOpenAI(deployment_name=deployment, temperature=temperature, openai_api_key=openai.api_key or "unset", max_retries=1)
+    llm.client = CompletionClient(approach, "agent")
+    return llm
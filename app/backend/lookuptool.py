@@ -1,20 +1,98 @@
-from os import path
+import asyncio
 import csv
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
 from langchain.agents import Tool
 from langchain.callbacks.manager import Callbacks
 from typing import Optional
 
+# One parse of a CSV file: rows as tuples in file order and, for each indexed field, a dict from value to row number.
+# Snapshots are never modified, a reload builds a new one and swaps it in
+@dataclass(frozen=True)
+class CsvSnapshot:
+    mtime: int
+    fields: tuple[str, ...]
+    rows: list[tuple[str, ...]]
+    indexes: dict[str, dict[str, int]]
+
+# A CSV file loaded once and shared by every tool that looks things up in it. The file's mtime is checked at most every
+# check_interval seconds and the file is parsed again when it changed. Lookups in progress keep using the snapshot they
+# started with, and if the new version can't be read the old one stays in use
+class CsvTable:
+    def __init__(self, filename: str, index_fields: tuple[str, ...], check_interval: float = 5):
+        self.filename = filename
+        self.index_fields = index_fields
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.snapshot = self.load()
+        self.checked = time.monotonic()
+
+    def load(self) -> CsvSnapshot:
+        mtime = os.stat(self.filename).st_mtime_ns
+        with open(self.filename, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            fields = tuple(next(reader, ()))
+            rows = [tuple(row) for row in reader]
+        indexes = {}
+        for field in self.index_fields:
+            # When a value repeats the last row wins, as it did when rows were loaded into a dict
+            column = fields.index(field)
+            indexes[field] = {row[column]: i for i, row in enumerate(rows) if column < len(row)}
+        return CsvSnapshot(mtime, fields, rows, indexes)
+
+    def needs_check(self) -> bool:
+        return time.monotonic() - self.checked >= self.check_interval
+
+    def refresh(self) -> CsvSnapshot:
+        with self.lock:
+            if self.needs_check():
+                self.checked = time.monotonic()
+                try:
+                    if os.stat(self.filename).st_mtime_ns != self.snapshot.mtime:
+                        self.snapshot = self.load()
+                        logging.info("Reloaded %s, %d rows", self.filename, len(self.snapshot.rows))
+                except (OSError, csv.Error, ValueError):
+                    logging.exception("Failed to reload %s, keeping the previous version", self.filename)
+        return self.snapshot
+
+    def get(self, field: str, key: str) -> Optional[dict[str, str]]:
+        snapshot = self.refresh() if self.needs_check() else self.snapshot
+        i = snapshot.indexes[field].get(key)
+        return None if i is None else dict(zip(snapshot.fields, snapshot.rows[i]))
+
+tables = {}
+tables_lock = threading.Lock()
+
+# Tables are shared per file and set of indexed fields, however many tools use them
+def get_table(filename: str, index_fields: tuple[str, ...]) -> CsvTable:
+    key = (os.path.realpath(filename), index_fields)
+    with tables_lock:
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = CsvTable(filename, index_fields)
+        return table
+
 class CsvLookupTool(Tool):
-    data: dict[str, str] = {}
+    table: Optional[CsvTable] = None
+    key_field: str = ""
 
-    def __init__(self, filename: path, key_field: str, name: str = "lookup", 
+    # Rows are looked up by key_field, and by any of index_fields when given to lookup()
+    def __init__(self, filename: str, key_field: str, name: str = "lookup",
                  description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
-                 callbacks: Callbacks = None):
+                 callbacks: Callbacks = None, index_fields: tuple[str, ...] = ()):
         super().__init__(name, self.lookup, description, callbacks=callbacks)
-        with open(filename, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
+        self.key_field = key_field
+        self.table = get_table(filename, (key_field,) + tuple(f for f in index_fields if f != key_field))
+
+    def lookup(self, key: str, field: str = None) -> Optional[str]:
+        row = self.table.get(field or self.key_field, key)
+        return "\n".join([f"{i}:{row[i]}" for i in row]) if row else ""
 
-    def lookup(self, key: str) -> Optional[str]:
-        return self.data.get(key, "")
+    # Same as lookup, but a reload, if one is due, happens in a thread instead of blocking the event loop
+    async def alookup(self, key: str, field: str = None) -> Optional[str]:
+        if self.table.needs_check():
+            await asyncio.to_thread(self.table.refresh)
+        return self.lookup(key, field)
@@ -0,0 +1,80 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Process wide counters and histograms, rendered in the Prometheus text format by the /metrics endpoint. Each gunicorn
+# worker keeps its own, so the scraper sees the worker that happened to serve the request
+counters = defaultdict(float)
+histograms = {}
+descriptions = {}
+bucket_bounds = {}
+
+# Latency buckets in seconds, from a cache hit to a long agent run
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def describe(name: str, description: str, buckets: tuple = None):
+    descriptions[name] = description
+    if buckets is not None:
+        bucket_bounds[name] = buckets
+
+def inc(name: str, value: float = 1.0, **labels: str):
+    counters[(name, tuple(sorted(labels.items())))] += value
+
+# Histograms use the buckets given to describe(), SECONDS_BUCKETS if none
+def observe(name: str, value: float, **labels: str):
+    key = (name, tuple(sorted(labels.items())))
+    bounds = bucket_bounds.get(name, SECONDS_BUCKETS)
+    histogram = histograms.get(key)
+    if histogram is None:
+        # counts per bucket (not cumulative), sum, count
+        histogram = histograms[key] = [[0] * len(bounds), 0.0, 0]
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            histogram[0][i] += 1
+            break
+    histogram[1] += value
+    histogram[2] += 1
+
+@contextmanager
+def timer(name: str, **labels: str):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+def render() -> str:
+    lines = []
+    by_name = defaultdict(list)
+    for (name, labels), value in counters.items():
+        by_name[name].append((labels, value))
+    for name in sorted(by_name):
+        if name in descriptions:
+            lines.append(f"# HELP {name} {descriptions[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in by_name[name]:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+    by_name = defaultdict(list)
+    for (name, labels), histogram in histograms.items():
+        by_name[name].append((labels, histogram))
+    for name in sorted(by_name):
+        if name in descriptions:
+            lines.append(f"# HELP {name} {descriptions[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        bounds = bucket_bounds.get(name, SECONDS_BUCKETS)
+        for labels, (counts, total, count) in by_name[name]:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def format_labels(labels: tuple) -> str:
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}" if labels else ""
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,220 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+import deadline
+import metrics
+from collections import deque
+from typing import Awaitable, Callable, Hashable, Optional, TypeVar
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from openai import error as openai_error
+
+T = TypeVar("T")
+
+metrics.describe("dependency_retries_total", "Calls to OpenAI or Cognitive Search retried after a transient failure, by reason")
+metrics.describe("dependency_retry_wait_seconds_total", "Time spent waiting before retries, backoff or Retry-After")
+metrics.describe("dependency_hedges_total", "Duplicate calls sent because the first one was slower than usual")
+metrics.describe("dependency_hedge_wins_total", "Hedged calls whose duplicate answered first")
+metrics.describe("circuit_breaker_transitions_total", "Circuit breaker state changes, by the state entered")
+metrics.describe("circuit_breaker_rejected_total", "Calls failed fast because the dependency's circuit breaker was open")
+
+# HTTP statuses worth trying again, the service is throttling or a replica is unhealthy
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class CircuitOpen(Exception):
+    pass
+
+# Why a failed call may succeed if tried again: the status code, "connection" or "timeout". None when it won't (bad
+# request, authentication...) or when the request's own deadline ran out
+def transient_reason(e: BaseException) -> Optional[str]:
+    if isinstance(e, deadline.DeadlineExceeded):
+        left = deadline.remaining()
+        return "timeout" if left is None or left > 0 else None
+    if isinstance(e, (openai_error.Timeout, openai_error.APIConnectionError, openai_error.TryAgain, ServiceRequestError, ServiceResponseError)):
+        return "connection"
+    if isinstance(e, openai_error.OpenAIError):
+        status = e.http_status
+    elif isinstance(e, HttpResponseError):
+        status = e.status_code
+    else:
+        return None
+    return str(status) if status in RETRY_STATUSES else None
+
+# Seconds the service asked to wait, from the retry-after-ms (Azure) or Retry-After (seconds or HTTP date) header
+def retry_after(e: BaseException) -> Optional[float]:
+    if isinstance(e, openai_error.OpenAIError):
+        headers = e.headers
+    else:
+        headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in headers.items()}
+    try:
+        for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+            if name in headers:
+                return float(headers[name]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Opens after failure_threshold transient failures in a row, then fails every call fast for reset_timeout seconds. After
+# that a single call goes through as a probe (half open): the circuit closes if it succeeds and opens again if it fails
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.transition("half_open")
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return self.state == "closed"
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != "closed":
+            self.transition("closed")
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self.transition("open")
+
+    # A call that ended without telling whether the dependency is healthy (cancelled, or a bad request)
+    def release(self):
+        self.probing = False
+
+    def transition(self, state: str):
+        logging.warning(f"Circuit breaker for {self.name}: {self.state} -> {state}")
+        self.state = state
+        metrics.inc("circuit_breaker_transitions_total", dependency=self.name, state=state)
+
+# Latencies of the last successful calls of one kind, the hedging threshold is a percentile of them. The percentile is
+# recomputed every refresh_every calls rather than sorting the window every time
+class LatencyWindow:
+    def __init__(self, size: int = 200, refresh_every: int = 20):
+        self.latencies = deque(maxlen=size)
+        self.refresh_every = refresh_every
+        self.count = 0
+        self.threshold = None
+
+    def add(self, seconds: float):
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def percentile(self, p: float, min_samples: int) -> Optional[float]:
+        if len(self.latencies) < min_samples:
+            return None
+        if self.threshold is None or self.count >= self.refresh_every:
+            ordered = sorted(self.latencies)
+            self.threshold = ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+            self.count = 0
+        return self.threshold
+
+# Retries, hedging and circuit breaking for the calls to one dependency. Transient failures are retried up to retries
+# times with jittered exponential backoff, or after the delay the service asks for with Retry-After, as long as the
+# request's deadline leaves time for it. With hedge_percentile set, a call still running after that percentile of the
+# recent latencies of its kind gets a duplicate, and the first answer wins. The breaker counts failures after each
+# attempt, throttling (429) isn't counted since the service is up and Retry-After takes care of it
+class Policy:
+    def __init__(self, name: str, retries: int = 3, backoff: float = 0.5, max_backoff: float = 8,
+                 hedge_percentile: float = 0, hedge_min_samples: int = 50, breaker: CircuitBreaker = None):
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker(name)
+        self.latencies = {}
+
+    # make creates the awaitable for one attempt, each attempt is limited to timeout seconds (and the deadline). kind
+    # groups calls with comparable latencies for hedging, calls that can't be duplicated (streams) pass hedge=False
+    async def call(self, make: Callable[[], Awaitable[T]], stage: str, timeout: float = None, kind: Hashable = None, hedge: bool = True) -> T:
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.inc("circuit_breaker_rejected_total", dependency=self.name)
+                raise CircuitOpen(f"{self.name} is unavailable, try again later")
+            try:
+                if hedge and self.hedge_percentile:
+                    return await self.hedged(make, stage, timeout, kind)
+                return await self.attempt(make, stage, timeout, kind)
+            except Exception as e:
+                reason = transient_reason(e)
+                if reason is None or attempt >= self.retries:
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                left = deadline.remaining()
+                if left is not None and delay >= left:
+                    raise
+                attempt += 1
+                metrics.inc("dependency_retries_total", dependency=self.name, reason=reason)
+                metrics.inc("dependency_retry_wait_seconds_total", delay, dependency=self.name)
+                await asyncio.sleep(delay)
+
+    async def attempt(self, make: Callable[[], Awaitable[T]], stage: str, timeout: Optional[float], kind: Hashable) -> T:
+        start = time.monotonic()
+        try:
+            result = await deadline.run(make(), stage, timeout)
+        except BaseException as e:
+            reason = transient_reason(e) if isinstance(e, Exception) else None
+            if reason is not None and reason != "429":
+                self.breaker.failure()
+            else:
+                self.breaker.release()
+            raise
+        self.breaker.success()
+        self.latencies.setdefault(kind, LatencyWindow()).add(time.monotonic() - start)
+        return result
+
+    async def hedged(self, make: Callable[[], Awaitable[T]], stage: str, timeout: Optional[float], kind: Hashable) -> T:
+        window = self.latencies.get(kind)
+        delay = window.percentile(self.hedge_percentile, self.hedge_min_samples) if window else None
+        if delay is None:
+            return await self.attempt(make, stage, timeout, kind)
+
+        first = asyncio.ensure_future(self.attempt(make, stage, timeout, kind))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            # Only duplicate calls to a healthy dependency, and never past the deadline
+            left = deadline.remaining()
+            if self.breaker.state != "closed" or (left is not None and left <= 0):
+                return await first
+            metrics.inc("dependency_hedges_total", dependency=self.name)
+            second = asyncio.ensure_future(self.attempt(make, stage, timeout, kind))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.inc("dependency_hedge_wins_total", dependency=self.name)
+                        return task.result()
+            # Both failed, the first call's error is the one retried or raised
+            raise first.exception()
+        finally:
+            for task in pending:
+                task.cancel()
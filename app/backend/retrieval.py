@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+import deadline
+import metrics
+from azure.search.documents.aio import SearchClient
+from azure.storage.blob.aio import ContainerClient
+from azure.search.documents.models import QueryType
+from cache import TTLCache
+from resilience import Policy
+
+# Container metadata entry that scripts/prepdocs.py updates every time it changes the index
+INDEX_VERSION_METADATA = "indexversion"
+
+metrics.describe("search_cache_hits_total", "Searches answered from the retrieval cache")
+metrics.describe("search_cache_misses_total", "Searches sent to Cognitive Search")
+metrics.describe("search_cache_saved_seconds_total", "Cognitive Search latency avoided by retrieval cache hits")
+metrics.describe("search_seconds_total", "Time spent waiting on Cognitive Search")
+
+# Tracks the version of the index content, as published by prepdocs on the storage container. The container is checked at
+# most every check_interval seconds, so a re-index shows up in the app within that delay
+class IndexVersion:
+    def __init__(self, blob_container: ContainerClient, check_interval: float = 30):
+        self.blob_container = blob_container
+        self.check_interval = check_interval
+        self.version = None
+        self.next_check = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self) -> str:
+        if time.monotonic() >= self.next_check:
+            async with self.lock:
+                if time.monotonic() >= self.next_check:
+                    try:
+                        properties = await deadline.run(self.blob_container.get_container_properties(), "index_version")
+                        self.version = properties.metadata.get(INDEX_VERSION_METADATA)
+                    except Exception:
+                        logging.exception(f"Failed to check the index version, keeping version {self.version}")
+                    self.next_check = time.monotonic() + self.check_interval
+        return self.version
+
+# Search layer shared by all approaches. Results are cached by query and search options, and the index version is part of
+# the cache key so entries from before a re-index are never served (they just age out of the cache). Cached results are
+# shared between requests and must not be modified by the callers. Searches take at most timeout seconds, less if the 
+# request's deadline comes first, and are retried, hedged and circuit broken by policy
+class Retriever:
+    def __init__(self, search_client: SearchClient, sourcepage_field: str, content_field: str,
+                 index_version: IndexVersion = None, cache_size: int = 1000, cache_ttl: float = 300, timeout: float = None,
+                 policy: Policy = None):
+        self.search_client = search_client
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.index_version = index_version
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.timeout = timeout
+        self.policy = policy or Policy("search")
+
+    # Returns the top documents for the query as dicts with "sourcefile", "sourcepage", "content" and, when semantic 
+    # captions are requested, "captions" (a list of caption texts)
+    async def search(self, q: str, overrides: dict) -> list[dict]:
+        use_semantic_ranker = True if overrides.get("semantic_ranker") else False
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        top = overrides.get("top") or 3
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+
+        version = await self.index_version.get() if self.index_version else None
+        key = (version, q, filter, top, use_semantic_ranker, use_semantic_captions)
+        cached = self.cache.get(key)
+        if cached is not None:
+            results, elapsed = cached
+            metrics.inc("search_cache_hits_total")
+            metrics.inc("search_cache_saved_seconds_total", elapsed)
+            return results
+        metrics.inc("search_cache_misses_total")
+
+        start = time.monotonic()
+        results = await self.policy.call(lambda: self.fetch(q, filter, top, use_semantic_ranker, use_semantic_captions), "search", self.timeout,
+                                         kind=use_semantic_ranker)
+        elapsed = time.monotonic() - start
+        metrics.inc("search_seconds_total", elapsed)
+
+        self.cache.set(key, (results, elapsed))
+        return results
+
+    async def fetch(self, q: str, filter: str, top: int, use_semantic_ranker: bool, use_semantic_captions: bool) -> list[dict]:
+        if use_semantic_ranker:
+            r = await self.search_client.search(q,
+                                          filter=filter,
+                                          query_type=QueryType.SEMANTIC,
+                                          query_language="en-us",
+                                          query_speller="lexicon",
+                                          semantic_configuration_name="default",
+                                          top=top,
+                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
+        else:
+            r = await self.search_client.search(q, filter=filter, top=top)
+        return [{"sourcefile": doc.get("sourcefile"),
+                 "sourcepage": doc[self.sourcepage_field],
+                 "content": doc[self.content_field],
+                 "captions": [c.text for c in doc['@search.captions']] if use_semantic_captions else None} async for doc in r]
@@ -0,0 +1,86 @@
+import metrics
+from dataclasses import dataclass
+from text import nonewlines
+from tokens import count_tokens, truncate_tokens
+
+metrics.describe("search_results", "Documents returned per search", (0, 1, 2, 3, 5, 10, 20, 50))
+
+# Shortest repeated text taken as an overlap between two chunks of the same file. prepdocs overlaps consecutive sections
+# by about 100 characters, adjusted to sentence and word boundaries
+MIN_OVERLAP = 20
+
+# A source cut to fewer tokens than this isn't worth the space it takes in the prompt
+MIN_SOURCE_TOKENS = 16
+
+@dataclass
+class Source:
+    sourcefile: str
+    sourcepage: str
+    text: str
+
+# Length of the longest suffix of a that is also a prefix of b, if it's at least MIN_OVERLAP long
+def overlap(a: str, b: str) -> int:
+    if len(b) < MIN_OVERLAP:
+        return 0
+    head = b[:MIN_OVERLAP]
+    i = a.find(head, max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(head, i + 1)
+    return 0
+
+# Removes text that's already present from the sources (in rank order), chunks from the same file that overlap lose the
+# repeated part, and when they are from the same page they are merged into one source
+def deduplicate(sources: list[Source]) -> list[Source]:
+    packed = []
+    for source in sources:
+        text = source.text
+        for p in packed:
+            if source.sourcefile is None or p.sourcefile != source.sourcefile or not text:
+                continue
+            if text in p.text:
+                text = ""
+            elif p.text in text and p.sourcepage == source.sourcepage:
+                p.text, text = text, ""
+            elif (n := overlap(p.text, text)) > 0:
+                if p.sourcepage == source.sourcepage:
+                    p.text, text = p.text + text[n:], ""
+                else:
+                    text = text[n:]
+            elif (n := overlap(text, p.text)) > 0:
+                if p.sourcepage == source.sourcepage:
+                    p.text, text = text + p.text[n:], ""
+                else:
+                    text = text[:-n]
+        if text:
+            packed.append(Source(source.sourcefile, source.sourcepage, text))
+    return packed
+
+# Packs the highest ranked sources, de-duplicated, into max_tokens (counting the "sourcepage: " prefix as well). Each source
+# can also be limited to max_source_tokens, and the last one that fits is cut to the remaining budget. Returns 
+# (sourcepage, text) pairs in rank order
+def pack_sources(sources: list[Source], max_tokens: int, max_source_tokens: int = None) -> list[tuple[str, str]]:
+    results = []
+    remaining = max_tokens
+    for source in deduplicate(sources):
+        text = truncate_tokens(source.text, max_source_tokens) if max_source_tokens else source.text
+        tokens = count_tokens(source.sourcepage) + 1 + count_tokens(text)
+        if tokens > remaining:
+            remaining -= count_tokens(source.sourcepage) + 1
+            if remaining >= MIN_SOURCE_TOKENS:
+                results.append((source.sourcepage, truncate_tokens(text, remaining)))
+            break
+        results.append((source.sourcepage, text))
+        remaining -= tokens
+    return results
+
+# The sources lines of an approach's prompt from the documents a search returned (see Retriever.search): their content, or
+# their captions with the semantic_captions override, packed with pack_sources. separator and caption_separator keep
+# each approach's prompt format as it is
+def format_sources(approach: str, docs: list[dict], overrides: dict, max_tokens: int, max_source_tokens: int = None,
+                   separator: str = ": ", caption_separator: str = " . ") -> list[str]:
+    metrics.observe("search_results", len(docs), approach=approach)
+    use_captions = overrides.get("semantic_captions")
+    sources = [Source(doc["sourcefile"], doc["sourcepage"], caption_separator.join(doc["captions"]) if use_captions else doc["content"]) for doc in docs]
+    return [sourcepage + separator + nonewlines(text) for sourcepage, text in pack_sources(sources, max_tokens, max_source_tokens)]
@@ -1,2 +1,14 @@
+import re
+
 def nonewlines(s: str) -> str:
     return s.replace('\n', ' ').replace('\r', ' ')
+
+def normalize(s: str) -> str:
+    return " ".join(s.lower().split())
+
+# Share of the words in query that also appear in text, ignoring case and punctuation
+def word_overlap(query: str, text: str) -> float:
+    query_words = set(re.findall(r"\w+", query.lower()))
+    if not query_words:
+        return 0.0
+    return len(query_words & set(re.findall(r"\w+", text.lower()))) / len(query_words)
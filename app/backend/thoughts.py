@@ -0,0 +1,97 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+from typing import Optional
+
+# The thought process of an answer is recorded as a trace, a list of events (dicts with a "type" and the event's fields,
+# see render_html for the types), and only rendered to the HTML the frontend shows when a client asks for it
+
+def ch(text: str) -> str:
+    s = text if isinstance(text, str) else str(text)
+    return s.replace("<", "&lt;").replace(">", "&gt;").replace("\r", "").replace("\n", "<br>")
+
+def color(event: dict) -> str:
+    return f" style='color:{event['color']}'" if event.get("color") else ""
+
+# Prompts are shown as they are, the sources in them may be HTML tables
+RENDERERS = {
+    "question": lambda e: f"Question:<br>{e['text']}<br><br>",
+    "search": lambda e: f"Searched for:<br>{e['query']}<br><br>",
+    "prompt": lambda e: "Prompt:<br>" + e["text"].replace("\n", "<br>"),
+    "llm_start": lambda e: "LLM prompts:<br>" + "<br>".join(ch(p) for p in e["prompts"]) + "<br>",
+    "llm_error": lambda e: f"<span style='color:red'>LLM error: {ch(e['error'])}</span><br>",
+    "chain_start": lambda e: f"Entering chain: {ch(e['name'])}<br>",
+    "chain_end": lambda e: "Finished chain<br>",
+    "chain_error": lambda e: f"<span style='color:red'>Chain error: {ch(e['error'])}</span><br>",
+    "tool_end": lambda e: f"{ch(e['observation_prefix'])}<br><span{color(e)}>{ch(e['output'])}</span><br>{ch(e['llm_prefix'])}<br>",
+    "tool_error": lambda e: f"<span style='color:red'>Tool error: {ch(e['error'])}</span><br>",
+    "text": lambda e: f"<span{color(e)}>{ch(e['text'])}</span><br>",
+    "agent_action": lambda e: f"<span{color(e)}>{ch(e['log'])}</span><br>",
+    "agent_finish": lambda e: f"<span{color(e)}>{ch(e['log'])}</span><br>",
+}
+
+def render_html(trace: list[dict]) -> str:
+    return "".join(RENDERERS[event["type"]](event) for event in trace if event["type"] in RENDERERS)
+
+TRACE_ID = re.compile(r"[0-9a-f]{32}")
+
+# Keeps traces for ttl seconds, so clients can fetch the thought process of an answer by its trace id when they need it.
+# Traces are gzipped JSON files in a directory shared by the app's worker processes, whichever worker gets the request
+# for a trace finds it. Files older than ttl are removed every sweep_interval seconds
+class TraceStore:
+    def __init__(self, directory: str = None, ttl: float = 3600, sweep_interval: float = 300):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "traces")
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.next_sweep = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    async def save(self, trace: list[dict]) -> str:
+        trace_id = uuid.uuid4().hex
+        sweep = time.monotonic() >= self.next_sweep
+        if sweep:
+            self.next_sweep = time.monotonic() + self.sweep_interval
+        await asyncio.to_thread(self.write, trace_id, trace, sweep)
+        return trace_id
+
+    async def load(self, trace_id: str) -> Optional[list[dict]]:
+        if not TRACE_ID.fullmatch(trace_id):
+            return None
+        return await asyncio.to_thread(self.read, trace_id)
+
+    def path(self, trace_id: str) -> str:
+        return os.path.join(self.directory, trace_id + ".json.gz")
+
+    def write(self, trace_id: str, trace: list[dict], sweep: bool):
+        path = self.path(trace_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(gzip.compress(json.dumps(trace, ensure_ascii=False).encode("utf-8"), compresslevel=5))
+        os.replace(path + ".tmp", path)
+        if sweep:
+            self.sweep()
+
+    def read(self, trace_id: str) -> Optional[list[dict]]:
+        try:
+            with open(self.path(trace_id), "rb") as f:
+                if os.fstat(f.fileno()).st_mtime < time.time() - self.ttl:
+                    return None
+                return json.loads(gzip.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+
+    def sweep(self):
+        expired = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logging.exception(f"Failed to remove expired trace {entry.path}")
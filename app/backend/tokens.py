@@ -0,0 +1,27 @@
+import tiktoken
+from functools import lru_cache
+
+# Encoding used to count prompt tokens. cl100k_base is the encoding of gpt-35-turbo, counts for the GPT-3 models
+# (p50k_base) are close enough to budget prompts with
+ENCODING = "cl100k_base"
+
+# Chat markup like <|im_start|>user\n...<|im_end|>\n around each message of a turn, as counted by the chat model
+TURN_OVERHEAD_TOKENS = 11
+
+@lru_cache(maxsize=None)
+def get_encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding(ENCODING)
+
+# Counts are cached by text, the same chat messages and sources come back with every turn of a conversation
+@lru_cache(maxsize=10000)
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+# For whole prompts, which are nearly all different: caching them would only hold on to their text and push the messages
+# and sources out of count_tokens' cache
+def count_prompt_tokens(prompt: str) -> int:
+    return len(get_encoding().encode(prompt, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    tokens = get_encoding().encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else get_encoding().decode(tokens[:max_tokens])
@@ -61,6 +61,17 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
     return parsedResponse;
 }
 
+export async function getThoughtsApi(traceId: string): Promise<string> {
+    const response = await fetch(`/trace/${traceId}`);
+
+    const parsedResponse: { thoughts?: string; error?: string } = await response.json();
+    if (response.status > 299 || !response.ok) {
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+
+    return parsedResponse.thoughts || "";
+}
+
 export function getCitationFilePath(citation: string): string {
     return `/content/${citation}`;
 }
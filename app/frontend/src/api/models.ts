@@ -24,7 +24,8 @@ export type AskRequest = {
 
 export type AskResponse = {
     answer: string;
-    thoughts: string | null;
+    thoughts?: string | null;
+    trace_id?: string;
     data_points: string[];
     error?: string;
 };
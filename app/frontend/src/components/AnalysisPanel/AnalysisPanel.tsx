@@ -1,10 +1,11 @@
+import { useEffect, useState } from "react";
 import { Pivot, PivotItem } from "@fluentui/react";
 import DOMPurify from "dompurify";
 
 import styles from "./AnalysisPanel.module.css";
 
 import { SupportingContent } from "../SupportingContent";
-import { AskResponse } from "../../api";
+import { AskResponse, getThoughtsApi } from "../../api";
 import { AnalysisPanelTabs } from "./AnalysisPanelTabs";
 
 interface Props {
@@ -19,11 +20,31 @@ interface Props {
 const pivotItemDisabledStyle = { disabled: true, style: { color: "grey" } };
 
 export const AnalysisPanel = ({ answer, activeTab, activeCitation, citationHeight, className, onActiveTabChanged }: Props) => {
-    const isDisabledThoughtProcessTab: boolean = !answer.thoughts;
+    const [thoughts, setThoughts] = useState<string | undefined>(answer.thoughts || undefined);
+
+    const isDisabledThoughtProcessTab: boolean = !answer.thoughts && !answer.trace_id;
     const isDisabledSupportingContentTab: boolean = !answer.data_points.length;
     const isDisabledCitationTab: boolean = !activeCitation;
 
-    const sanitizedThoughts = DOMPurify.sanitize(answer.thoughts!);
+    // Answers come with the id of their thought process, which is only fetched when the tab is shown
+    useEffect(() => {
+        setThoughts(answer.thoughts || undefined);
+    }, [answer]);
+
+    useEffect(() => {
+        if (activeTab !== AnalysisPanelTabs.ThoughtProcessTab || thoughts !== undefined || !answer.trace_id) {
+            return;
+        }
+        let cancelled = false;
+        getThoughtsApi(answer.trace_id)
+            .then(html => !cancelled && setThoughts(html))
+            .catch(e => !cancelled && setThoughts(`Thought process not available: ${e.message}`));
+        return () => {
+            cancelled = true;
+        };
+    }, [activeTab, answer, thoughts]);
+
+    const sanitizedThoughts = DOMPurify.sanitize(thoughts ?? "Loading...");
 
     return (
         <Pivot
@@ -43,7 +43,7 @@ export const Answer = ({
                             title="Show thought process"
                             ariaLabel="Show thought process"
                             onClick={() => onThoughtProcessClicked()}
-                            disabled={!answer.thoughts}
+                            disabled={!answer.thoughts && !answer.trace_id}
                         />
                         <IconButton
                             style={{ color: "black" }}
@@ -1,10 +1,18 @@
 import os
 import argparse
+import bisect
 import glob
+import hashlib
 import html
 import io
+import json
+import multiprocessing
+import queue
 import re
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pypdf import PdfReader, PdfWriter
 from azure.identity import AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
@@ -17,6 +25,21 @@ from azure.ai.formrecognizer import DocumentAnalysisClient
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+BLOB_UPLOAD_CONCURRENCY = 8
+# Removal: concurrent delete requests, sections per index batch, blobs per batch delete call (the service maximum), files
+# per search filter, and sections per key-only scan (the most the service pages through)
+REMOVE_CONCURRENCY = 8
+SEARCH_BATCH_SIZE = 1000
+BLOB_DELETE_BATCH_SIZE = 256
+SEARCH_FILTER_FILES = 100
+SEARCH_SCAN_LIMIT = 100000
+# A scan that only finds sections already deleted (the deletes aren't indexed yet) is retried after this many seconds, up
+# to this many times
+SEARCH_RESCAN_WAIT = 1
+SEARCH_RESCAN_ATTEMPTS = 30
+# The manifest is written after this many updates or seconds, whichever comes first, and at the end of the run
+MANIFEST_SAVE_UPDATES = 100
+MANIFEST_SAVE_INTERVAL = 30
 
 parser = argparse.ArgumentParser(
     description="Prepare documents by extracting content from PDFs, splitting content into sections, uploading to blob storage, and indexing in a search index.",
@@ -37,21 +60,101 @@ parser.add_argument("--removeall", action="store_true", help="Remove all blobs f
 parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
 parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
 parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+parser.add_argument("--manifest", required=False, help="Optional. Path to a local manifest of what has been ingested so far. When set, files that haven't changed since the last run are skipped, and for changed files only the sections and page blobs whose content changed are uploaded or deleted. With --remove, the section ids and blob names it has for the files are deleted without looking them up")
+parser.add_argument("--workers", type=int, default=1, help="Optional. Number of files to process in parallel: PDF parsing and splitting run in a pool of this many processes, blob uploads and indexing in as many threads (default: 1, one file at a time)")
 parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
-args = parser.parse_args()
-
-# Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
-azd_credential = AzureDeveloperCliCredential() if args.tenantid == None else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
-default_creds = azd_credential if args.searchkey == None or args.storagekey == None else None
-search_creds = default_creds if args.searchkey == None else AzureKeyCredential(args.searchkey)
-if not args.skipblobs:
-    storage_creds = default_creds if args.storagekey == None else args.storagekey
-if not args.localpdfparser:
-    # check if Azure Form Recognizer credentials are provided
-    if args.formrecognizerservice == None:
-        print("Error: Azure Form Recognizer service is not provided. Please provide formrecognizerservice or use --localpdfparser for local pypdf parser.")
-        exit(1)
-    formrecognizer_creds = default_creds if args.formrecognizerkey == None else AzureKeyCredential(args.formrecognizerkey)
+# Defaults until configure() is called with the command line, so the processing functions below can be imported and used
+# on their own without parsing arguments or creating credentials
+args = parser.parse_args([""])
+search_creds = None
+storage_creds = None
+formrecognizer_creds = None
+
+def configure(arguments):
+    global args, search_creds, storage_creds, formrecognizer_creds
+    args = arguments
+    # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
+    azd_credential = AzureDeveloperCliCredential() if args.tenantid == None else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
+    default_creds = azd_credential if args.searchkey == None or args.storagekey == None else None
+    search_creds = default_creds if args.searchkey == None else AzureKeyCredential(args.searchkey)
+    if not args.skipblobs:
+        storage_creds = default_creds if args.storagekey == None else args.storagekey
+    if not args.localpdfparser:
+        # check if Azure Form Recognizer credentials are provided
+        if args.formrecognizerservice == None:
+            print("Error: Azure Form Recognizer service is not provided. Please provide formrecognizerservice or use --localpdfparser for local pypdf parser.")
+            exit(1)
+        formrecognizer_creds = default_creds if args.formrecognizerkey == None else AzureKeyCredential(args.formrecognizerkey)
+
+def content_hash(data):
+    return hashlib.sha256(data if isinstance(data, bytes) else data.encode("utf-8")).hexdigest()
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest:
+    """Local record of the page blobs and index sections created for each file, with the hash of the file they were
+    created from and a hash of each blob and section. The blobs and sections of a file are tracked separately, since
+    they're uploaded independently (and blobs may be skipped altogether). Updates are saved in batches, call flush()
+    when done: updates lost in an interrupted run only mean those files are processed again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            # A manifest written for another index or container says nothing about this one
+            if manifest.get("index") == args.index and manifest.get("container") == args.container:
+                self.files = manifest.get("files", {})
+            elif args.verbose:
+                print(f"Manifest '{path}' was created for a different index or container, ignoring it")
+
+    def get(self, filename, part):
+        return self.files.get(os.path.basename(filename), {}).get(part)
+
+    def is_unchanged(self, filename, part, hash):
+        record = self.get(filename, part)
+        return record is not None and record["hash"] == hash and record.get("category") == (args.category if part == "sections" else None)
+
+    def set(self, filename, part, hash, items):
+        record = { "hash": hash, "items": items }
+        if part == "sections": record["category"] = args.category
+        with self.lock:
+            self.files.setdefault(os.path.basename(filename), {})[part] = record
+            self.unsaved += 1
+            if self.unsaved >= MANIFEST_SAVE_UPDATES or time.monotonic() - self.saved_at >= MANIFEST_SAVE_INTERVAL:
+                self.save()
+
+    def remove(self, filenames):
+        with self.lock:
+            if filenames == None:
+                self.files = {}
+            else:
+                for filename in filenames:
+                    self.files.pop(os.path.basename(filename), None)
+            self.save()
+
+    def flush(self):
+        with self.lock:
+            if self.unsaved:
+                self.save()
+
+    def save(self):
+        # write to a temporary file and swap it in, so an interrupted run never leaves a truncated manifest behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({ "index": args.index, "container": args.container, "files": self.files }, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
 
 def blob_name_from_file_page(filename, page = 0):
     if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -59,65 +162,106 @@ def blob_name_from_file_page(filename, page = 0):
     else:
         return os.path.basename(filename)
 
-def upload_blobs(filename):
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if not blob_container.exists():
-        blob_container.create_container()
+blob_container = None
+blob_container_lock = threading.Lock()
+
+def get_blob_container():
+    # One client (and connection pool) for the whole run, the container is checked and created only the first time
+    global blob_container
+    with blob_container_lock:
+        if blob_container == None:
+            blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
+            container = blob_service.get_container_client(args.container)
+            if not container.exists():
+                container.create_container()
+            blob_container = container
+    return blob_container
+
+# Set once this run has uploaded, indexed or removed anything, only then is a new index version published
+index_changed = threading.Event()
+
+def publish_index_version():
+    # The app keys its search caches on this container metadata entry, changing it makes running apps drop cached results
+    container = get_blob_container()
+    metadata = container.get_container_properties().metadata or {}
+    metadata["indexversion"] = str(time.time_ns())
+    container.set_container_metadata(metadata)
+    if args.verbose: print(f"Published index version {metadata['indexversion']}")
+
+def is_pdf(filename):
+    return os.path.splitext(filename)[1].lower() == ".pdf"
 
+def get_blobs(filename, reader=None):
     # if file is PDF split into pages and upload each page as a separate blob
-    if os.path.splitext(filename)[1].lower() == ".pdf":
-        reader = PdfReader(filename)
-        pages = reader.pages
+    if is_pdf(filename):
+        pages = (reader or PdfReader(filename)).pages
         for i in range(len(pages)):
-            blob_name = blob_name_from_file_page(filename, i)
-            if args.verbose: print(f"\tUploading blob for page {i} -> {blob_name}")
             f = io.BytesIO()
             writer = PdfWriter()
             writer.add_page(pages[i])
             writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
+            yield blob_name_from_file_page(filename, i), f.getvalue()
     else:
-        blob_name = blob_name_from_file_page(filename)
         with open(filename,"rb") as data:
-            blob_container.upload_blob(blob_name, data, overwrite=True)
+            yield blob_name_from_file_page(filename), data.read()
 
-def remove_blobs(filename):
-    if args.verbose: print(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(args.container)
-    if blob_container.exists():
-        if filename == None:
-            blobs = blob_container.list_blob_names()
+def upload_blobs(filename, uploaded_blobs=None, blobs=None):
+    blob_container = get_blob_container()
+
+    # if uploaded_blobs (blob name -> content hash from a previous run) is given, skip the blobs that didn't change 
+    # and delete the ones that no longer exist
+    def upload(blob):
+        blob_name, data = blob
+        hash = content_hash(data)
+        if uploaded_blobs is not None and uploaded_blobs.get(blob_name) == hash:
+            if args.verbose: print(f"\tSkipping unchanged blob {blob_name}")
         else:
-            prefix = os.path.splitext(os.path.basename(filename))[0]
-            blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
-        for b in blobs:
-            if args.verbose: print(f"\tRemoving blob {b}")
+            if args.verbose: print(f"\tUploading blob {blob_name}")
+            blob_container.upload_blob(blob_name, data, overwrite=True)
+            index_changed.set()
+        return blob_name, hash
+
+    # pages are split as they're uploaded, only a few ahead of the uploads, so a file's pages are never all in memory
+    blob_hashes = {}
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=BLOB_UPLOAD_CONCURRENCY) as upload_pool:
+        for blob in blobs if blobs is not None else get_blobs(filename):
+            in_flight.append(upload_pool.submit(upload, blob))
+            if len(in_flight) >= BLOB_UPLOAD_CONCURRENCY * 2:
+                blob_hashes.update([in_flight.popleft().result()])
+        blob_hashes.update(f.result() for f in in_flight)
+
+    if uploaded_blobs is not None:
+        for b in uploaded_blobs.keys() - blob_hashes.keys():
+            if args.verbose: print(f"\tRemoving stale blob {b}")
             blob_container.delete_blob(b)
+            index_changed.set()
+    return blob_hashes
 
 def table_to_html(table):
-    table_html = "<table>"
-    rows = [sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index) for i in range(table.row_count)]
+    # group the cells by row in a single pass, cells keep their order within a row before sorting by column
+    rows = [[] for _ in range(table.row_count)]
+    for cell in table.cells:
+        if cell.row_index < table.row_count:
+            rows[cell.row_index].append(cell)
+    table_html = ["<table>"]
     for row_cells in rows:
-        table_html += "<tr>"
-        for cell in row_cells:
+        table_html.append("<tr>")
+        for cell in sorted(row_cells, key=lambda cell: cell.column_index):
             tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
             cell_spans = ""
             if cell.column_span > 1: cell_spans += f" colSpan={cell.column_span}"
             if cell.row_span > 1: cell_spans += f" rowSpan={cell.row_span}"
-            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-        table_html +="</tr>"
-    table_html += "</table>"
-    return table_html
+            table_html.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+        table_html.append("</tr>")
+    table_html.append("</table>")
+    return "".join(table_html)
 
-def get_document_text(filename):
+def get_document_text(filename, reader=None):
     offset = 0
     page_map = []
     if args.localpdfparser:
-        reader = PdfReader(filename)
-        pages = reader.pages
+        pages = (reader or PdfReader(filename)).pages
         for page_num, p in enumerate(pages):
             page_text = p.extract_text()
             page_map.append((page_num, offset, page_text))
@@ -128,79 +272,117 @@ def get_document_text(filename):
         with open(filename, "rb") as f:
             poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
         form_recognizer_results = poller.result()
+        page_map = get_form_recognizer_page_map(form_recognizer_results)
+
+    return page_map
 
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1]
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
+def get_form_recognizer_page_map(form_recognizer_results):
+    offset = 0
+    page_map = []
+    content = form_recognizer_results.content
+    tables_by_page = {}
+    for table in form_recognizer_results.tables:
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
+
+    for page_num, page in enumerate(form_recognizer_results.pages):
+        tables_on_page = tables_by_page.get(page_num + 1, [])
+
+        # collect the table spans in the page as [start, end) ranges relative to the page, clipped to the page
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_spans = []
+        for table_id, table in enumerate(tables_on_page):
+            for span in table.spans:
+                start = max(span.offset - page_offset, 0)
+                end = min(span.offset - page_offset + span.length, page_length)
+                if start < end:
+                    table_spans.append((start, end, table_id))
+
+        # build page text by copying the text between table spans and replacing each table with its html the first
+        # time one of its spans is reached. Where spans overlap the later table wins, as each position belongs to one table
+        boundaries = sorted({0, page_length}.union(*((start, end) for start, end, _ in table_spans)))
+        starting = {}
+        ending = {}
+        for start, end, table_id in table_spans:
+            starting.setdefault(start, []).append(table_id)
+            ending.setdefault(end, []).append(table_id)
+        active = {}
+        page_text = []
+        added_tables = set()
+        for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+            for table_id in ending.get(segment_start, []):
+                active[table_id] -= 1
+                if active[table_id] == 0: del active[table_id]
+            for table_id in starting.get(segment_start, []):
+                active[table_id] = active.get(table_id, 0) + 1
+            if not active:
+                page_text.append(content[page_offset + segment_start : page_offset + segment_end])
+            else:
+                table_id = max(active)
+                if not table_id in added_tables:
+                    page_text.append(table_to_html(tables_on_page[table_id]))
                     added_tables.add(table_id)
 
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        page_text.append(" ")
+        page_text = "".join(page_text)
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
 
     return page_map
 
 def split_text(page_map):
     SENTENCE_ENDINGS = [".", "!", "?"]
     WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
-    if args.verbose: print(f"Splitting '{filename}' into sections")
 
+    page_offsets = [p[1] for p in page_map]
     def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
+        i = bisect.bisect_right(page_offsets, offset) - 1
+        return i if i >= 0 else len(page_map) - 1
 
     all_text = "".join(p[2] for p in page_map)
     length = len(all_text)
+
+    # Find all sentence endings once, section boundaries are then looked up with a binary search instead of scanning 
+    # the text around each boundary character by character. Word breaks are much more frequent and only needed when 
+    # there's no sentence ending nearby, so those are searched for within the (short) window around the boundary
+    sentence_endings = [m.start() for m in re.finditer("[" + re.escape("".join(SENTENCE_ENDINGS)) + "]", all_text)]
+    first_word_break = re.compile("[" + re.escape("".join(WORDS_BREAKS)) + "]")
+    last_word_break = re.compile(".*[" + re.escape("".join(WORDS_BREAKS)) + "]", re.DOTALL)
+
     start = 0
     end = length
     while start + SECTION_OVERLAP < length:
-        last_word = -1
         end = start + MAX_SECTION_LENGTH
 
         if end > length:
             end = length
         else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
+            # Try to find the end of the sentence within SENTENCE_SEARCH_LIMIT characters
+            limit = min(length, end + SENTENCE_SEARCH_LIMIT)
+            i = bisect.bisect_left(sentence_endings, end)
+            if i < len(sentence_endings) and sentence_endings[i] < limit:
+                end = sentence_endings[i]
+            else:
+                m = last_word_break.match(all_text, end, limit)
+                last_word = m.end() - 1 if m else -1
+                end = limit
+                if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                    end = last_word # Fall back to at least keeping a whole word
         if end < length:
             end += 1
 
         # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
+        lower_bound = max(0, end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT)
+        if start > lower_bound:
+            i = bisect.bisect_right(sentence_endings, start) - 1
+            if i >= 0 and sentence_endings[i] > lower_bound:
+                start = sentence_endings[i]
+            else:
+                m = first_word_break.search(all_text, lower_bound + 1, start + 1)
+                last_word = m.start() if m else -1
+                start = lower_bound
+                if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+                    start = last_word
         if start > 0:
             start += 1
 
@@ -221,6 +403,7 @@ def split_text(page_map):
         yield (all_text[start:end], find_page(start))
 
 def create_sections(filename, page_map):
+    if args.verbose: print(f"Splitting '{filename}' into sections")
     for i, (section, pagenum) in enumerate(split_text(page_map)):
         yield {
             "id": re.sub("[^0-9a-zA-Z_-]","_",f"{filename}-{i}"),
@@ -255,61 +438,274 @@ def create_search_index():
     else:
         if args.verbose: print(f"Search index {args.index} already exists")
 
-def index_sections(filename, sections):
+def get_search_client():
+    return SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
+                        index_name=args.index,
+                        credential=search_creds)
+
+def index_sections(filename, sections, indexed_sections=None):
     if args.verbose: print(f"Indexing sections from '{filename}' into search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
+    search_client = get_search_client()
+    # if indexed_sections (section id -> content hash from a previous run) is given, skip the sections that didn't 
+    # change and delete the ones that no longer exist
+    section_hashes = {}
+    failed = set()
     i = 0
     batch = []
     for s in sections:
+        section_hashes[s["id"]] = content_hash(json.dumps(s, sort_keys=True))
+        if indexed_sections is not None and indexed_sections.get(s["id"]) == section_hashes[s["id"]]:
+            continue
         batch.append(s)
+        index_changed.set()
         i += 1
         if i % 1000 == 0:
             results = search_client.upload_documents(documents=batch)
             succeeded = sum([1 for r in results if r.succeeded])
             if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+            failed.update(r.key for r in results if not r.succeeded)
             batch = []
 
     if len(batch) > 0:
         results = search_client.upload_documents(documents=batch)
         succeeded = sum([1 for r in results if r.succeeded])
         if args.verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        failed.update(r.key for r in results if not r.succeeded)
+
+    if indexed_sections is not None:
+        if args.verbose: print(f"\tSkipped {len(section_hashes) - i} unchanged sections")
+        stale = list(indexed_sections.keys() - section_hashes.keys())
+        for start in range(0, len(stale), 1000):
+            index_changed.set()
+            results = search_client.delete_documents(documents=[{ "id": id } for id in stale[start:start + 1000]])
+            if args.verbose: print(f"\tRemoved {len(results)} stale sections from index")
+    # leave out the sections that failed to index, so they're retried on the next run
+    return { id: h for id, h in section_hashes.items() if id not in failed }
+
+def batches(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def find_sections(search_client, filenames):
+    # Key-only scan of the sections of these files (all of them if filenames is None), paged by the service 1000 at a
+    # time. Files are matched in groups with search.in to keep the filters short, and since the service won't page past
+    # SEARCH_SCAN_LIMIT results, a scan that hits the limit is repeated after the sections found are deleted. Deletes
+    # take a moment to be indexed, the repeated scan can return sections already found: those are skipped, and a scan
+    # with nothing new waits for the deletes (the id field isn't sortable, so the scan can't page by id instead)
+    names = [None] if filenames is None else list(batches(sorted({ os.path.basename(f) for f in filenames }), SEARCH_FILTER_FILES))
+    for group in names:
+        filter = None if group is None else "search.in(sourcefile, '{}', '|')".format("|".join(group).replace("'", "''"))
+        found = set()
+        attempts = 0
+        while True:
+            ids = [d["id"] for d in search_client.search("*", filter=filter, select=["id"], top=SEARCH_SCAN_LIMIT)]
+            new_ids = [id for id in ids if id not in found]
+            found.update(new_ids)
+            if new_ids:
+                attempts = 0
+                yield new_ids
+            if len(ids) < SEARCH_SCAN_LIMIT:
+                break
+            if not new_ids:
+                attempts += 1
+                if attempts > SEARCH_RESCAN_ATTEMPTS:
+                    print(f"Error: {len(ids)} deleted sections are still found in search index '{args.index}', run the removal again")
+                    exit(1)
+                time.sleep(SEARCH_RESCAN_WAIT)
+
+def find_blobs(blob_container, filenames):
+    # One listing of the blob names under the prefix the files have in common, matched against the page blob names of
+    # the files (every blob if filenames is None)
+    if filenames is None:
+        return list(blob_container.list_blob_names())
+    pdf_stems = { os.path.splitext(os.path.basename(f))[0] for f in filenames if is_pdf(f) }
+    other_names = { os.path.basename(f) for f in filenames if not is_pdf(f) }
+    prefix = os.path.commonprefix(list(pdf_stems | other_names))
+    blob_names = []
+    for name in blob_container.list_blob_names(name_starts_with=prefix or None):
+        m = re.fullmatch(r"(.*)-\d+\.pdf", name, re.IGNORECASE)
+        if name in other_names or (m and m.group(1) in pdf_stems):
+            blob_names.append(name)
+    return blob_names
+
+def delete_sections(search_client, ids):
+    def delete(batch):
+        index_changed.set()
+        results = search_client.delete_documents(documents=[{ "id": id } for id in batch])
+        failed = sum(1 for r in results if not r.succeeded)
+        if args.verbose: print(f"\tRemoved {len(results) - failed} sections from index" + (f", {failed} failed" if failed else ""))
+        return failed
+
+    with ThreadPoolExecutor(max_workers=REMOVE_CONCURRENCY) as pool:
+        return sum(pool.map(delete, batches(ids, SEARCH_BATCH_SIZE)))
+
+def delete_blobs(blob_container, blob_names):
+    def delete(batch):
+        index_changed.set()
+        # Blobs that are already gone (404) are as good as deleted
+        responses = blob_container.delete_blobs(*batch, raise_on_any_failure=False)
+        failed = sum(1 for r in responses if r.status_code not in (202, 404))
+        if args.verbose: print(f"\tRemoved {len(batch) - failed} blobs" + (f", {failed} failed" if failed else ""))
+        return failed
+
+    with ThreadPoolExecutor(max_workers=REMOVE_CONCURRENCY) as pool:
+        return sum(pool.map(delete, batches(blob_names, BLOB_DELETE_BATCH_SIZE)))
+
+def remove_files(filenames, manifest=None):
+    # Removes the page blobs and index sections of the files, or of everything if filenames is None. For files the
+    # manifest has a record of, its section ids and blob names are used as they are, the others are looked up
+    if args.verbose: print(f"Removing {'all files' if filenames is None else f'{len(filenames)} files'} from blob storage and search index '{args.index}'")
+    section_ids, blob_names = [], []
+    unknown_sections, unknown_blobs = filenames, filenames
+    if manifest and filenames is not None:
+        unknown_sections, unknown_blobs = [], []
+        for filename in filenames:
+            sections, blobs = manifest.get(filename, "sections"), manifest.get(filename, "blobs")
+            if sections: section_ids.extend(sections["items"])
+            else: unknown_sections.append(filename)
+            if blobs: blob_names.extend(blobs["items"])
+            else: unknown_blobs.append(filename)
+
+    failed = 0
+    search_client = get_search_client()
+    failed += delete_sections(search_client, section_ids)
+    if unknown_sections is None or unknown_sections:
+        for ids in find_sections(search_client, unknown_sections):
+            failed += delete_sections(search_client, ids)
+
+    if not args.skipblobs:
+        blob_container = get_blob_container()
+        if unknown_blobs is None or unknown_blobs:
+            blob_names += find_blobs(blob_container, unknown_blobs)
+        failed += delete_blobs(blob_container, sorted(set(blob_names)))
+
+    if failed:
+        print(f"Error: {failed} sections or blobs failed to be removed, run the removal again")
+        exit(1)
+    if manifest: manifest.remove(filenames)
+
+def get_changes(filename, manifest=None, hash=None):
+    # Whether the page blobs and the index sections of the file need to be (re)created
+    upload = not args.skipblobs and not (manifest and manifest.is_unchanged(filename, "blobs", hash))
+    index = not (manifest and manifest.is_unchanged(filename, "sections", hash))
+    if manifest and args.verbose:
+        if not args.skipblobs and not upload: print(f"\tSkipping blobs for unchanged '{filename}'")
+        if not index: print(f"\tSkipping sections for unchanged '{filename}'")
+    return upload, index
+
+def parse_file(filename, split_pages=True, extract_sections=True, uploaded_blobs=None):
+    # PDFs are parsed once, both to split them into page blobs and to extract their text with the local parser. Pages
+    # are uploaded as they're split, only their names and hashes are returned (to the parent process, with --workers)
+    reader = PdfReader(filename) if is_pdf(filename) and (split_pages or (extract_sections and args.localpdfparser)) else None
+    blob_hashes = upload_blobs(filename, uploaded_blobs, get_blobs(filename, reader)) if split_pages else None
+    sections = list(create_sections(os.path.basename(filename), get_document_text(filename, reader))) if extract_sections else None
+    return blob_hashes, sections
+
+def get_uploaded_blobs(filename, manifest=None):
+    record = manifest.get(filename, "blobs") if manifest else None
+    return record["items"] if record else None
+
+def record_file_blobs(filename, blob_hashes, manifest=None, hash=None):
+    # Pages may have been uploaded by a worker process, whether any blob changed is told by comparing with the manifest
+    if blob_hashes != get_uploaded_blobs(filename, manifest):
+        index_changed.set()
+    if manifest:
+        manifest.set(filename, "blobs", hash, blob_hashes)
+
+def index_file_sections(filename, sections, manifest=None, hash=None):
+    if manifest == None:
+        index_sections(os.path.basename(filename), sections)
+    else:
+        record = manifest.get(filename, "sections")
+        manifest.set(filename, "sections", hash, index_sections(os.path.basename(filename), sections, record["items"] if record else {}))
+
+def process_files(filenames, manifest=None):
+    # Pipeline over files: parsing, text extraction and splitting are CPU bound and run in a process pool, along with
+    # uploading the pages as they're split. Indexing is I/O bound and runs in a thread pool, parsed files are handed to
+    # it through a bounded queue and at most a few files are parsed ahead, so memory stays flat regardless of the number of files
+    workers = args.workers
+    parsed = queue.Queue(maxsize=workers * 2)
+    errors = []
+
+    def index_parsed():
+        while (item := parsed.get()) is not None:
+            filename, hash, sections = item
+            try:
+                index_file_sections(filename, sections, manifest, hash)
+            except Exception as e:
+                # keep draining the queue so the parsing stage doesn't block, errors are reported at the end
+                print(f"Error indexing sections from '{filename}': {e}")
+                errors.append(e)
+
+    def dispatch(filename, hash, parsing):
+        blob_hashes, sections = parsing.result()
+        if blob_hashes is not None:
+            record_file_blobs(filename, blob_hashes, manifest, hash)
+        if sections is not None:
+            parsed.put((filename, hash, sections))
+
+    # Worker processes are spawned rather than forked, forking while the upload and indexing threads hold locks can deadlock.
+    # Spawned processes import this module afresh, so they're configured with the same arguments
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=configure, initargs=(args,)) as parse_pool, \
+         ThreadPoolExecutor(max_workers=workers) as index_pool:
+        indexers = [index_pool.submit(index_parsed) for _ in range(workers)]
+        pending = deque()
+        try:
+            for filename in filenames:
+                if args.verbose: print(f"Processing '{filename}'")
+                hash = file_hash(filename) if manifest else None
+                split_pages, extract_sections = get_changes(filename, manifest, hash)
+                if not split_pages and not extract_sections:
+                    continue
+                pending.append((filename, hash, parse_pool.submit(parse_file, filename, split_pages, extract_sections, get_uploaded_blobs(filename, manifest))))
+                if len(pending) >= workers * 2:
+                    dispatch(*pending.popleft())
+            while pending:
+                dispatch(*pending.popleft())
+        finally:
+            for _ in indexers:
+                parsed.put(None)
+        for f in indexers:
+            f.result()
+
+    if errors:
+        print(f"Error: {len(errors)} files failed to index")
+        exit(1)
 
-def remove_from_index(filename):
-    if args.verbose: print(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
-    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
-                                    index_name=args.index,
-                                    credential=search_creds)
-    while True:
-        filter = None if filename == None else f"sourcefile eq '{os.path.basename(filename)}'"
-        r = search_client.search("", filter=filter, top=1000, include_total_count=True)
-        if r.get_count() == 0:
-            break
-        r = search_client.delete_documents(documents=[{ "id": d["id"] } for d in r])
-        if args.verbose: print(f"\tRemoved {len(r)} sections from index")
-        # It can take a few seconds for search results to reflect changes, so wait a bit
-        time.sleep(2)
-
-if args.removeall:
-    remove_blobs(None)
-    remove_from_index(None)
-else:
-    if not args.remove:
-        create_search_index()
-    
-    print(f"Processing files...")
-    for filename in glob.glob(args.files):
-        if args.verbose: print(f"Processing '{filename}'")
-        if args.remove:
-            remove_blobs(filename)
-            remove_from_index(filename)
-        elif args.removeall:
-            remove_blobs(None)
-            remove_from_index(None)
+if __name__ == "__main__":
+    configure(parser.parse_args())
+    manifest = Manifest(args.manifest) if args.manifest else None
+    succeeded = False
+    try:
+        if args.removeall:
+            remove_files(None, manifest)
+        elif args.remove:
+            remove_files(glob.glob(args.files), manifest)
         else:
-            if not args.skipblobs:
-                upload_blobs(filename)
-            page_map = get_document_text(filename)
-            sections = create_sections(os.path.basename(filename), page_map)
-            index_sections(os.path.basename(filename), sections)
+            create_search_index()
+            
+            print(f"Processing files...")
+            if args.workers > 1:
+                process_files(glob.glob(args.files), manifest)
+            else:
+                for filename in glob.glob(args.files):
+                    if args.verbose: print(f"Processing '{filename}'")
+                    hash = file_hash(filename) if manifest else None
+                    split_pages, extract_sections = get_changes(filename, manifest, hash)
+                    blob_hashes, sections = parse_file(filename, split_pages, extract_sections, get_uploaded_blobs(filename, manifest))
+                    if split_pages:
+                        record_file_blobs(filename, blob_hashes, manifest, hash)
+                    if extract_sections:
+                        index_file_sections(filename, sections, manifest, hash)
+        succeeded = True
+    finally:
+        if manifest: manifest.flush()
+        # also after a failed run, some of the files may have been indexed already. The version lives in the container's
+        # metadata, so there's none to publish with --skipblobs. Failing to publish doesn't hide why the run failed
+        if index_changed.is_set() and not args.skipblobs:
+            try:
+                publish_index_version()
+            except Exception as e:
+                print(f"Error: failed to publish the index version, running apps keep their cached results until they expire: {e}")
+                if succeeded: exit(1)
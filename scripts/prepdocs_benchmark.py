@@ -0,0 +1,164 @@
+import argparse
+import gc
+import glob
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from azure.ai.formrecognizer import AnalyzeResult, BoundingRegion, DocumentPage, DocumentSpan, DocumentTable, DocumentTableCell
+import prepdocs
+
+# Benchmarks the processing stages of prepdocs (Form Recognizer results to page map, tables to HTML, splitting into
+# sections) on synthetic documents, measuring time and peak memory of each stage. Nothing is sent to Azure. Run it from
+# the scripts folder, for example:
+#   python prepdocs_benchmark.py --save prepdocs_baseline.json
+#   python prepdocs_benchmark.py --compare prepdocs_baseline.json
+#   python prepdocs_benchmark.py --scenarios large --pdfs '../data/*.pdf'
+
+# pages, tables per page, rows and columns per table
+SCENARIOS = {
+    "small": (5, 0, 0, 0),
+    "medium": (100, 0.2, 8, 4),
+    "large": (2000, 0.2, 8, 4),
+    "tables": (200, 3, 20, 6),
+}
+
+WORDS = "the plan covers in-network and out-of-network providers with a deductible copay coinsurance for each employee " \
+        "and family member including prescription vision dental wellness benefits claims eligibility enrollment".split()
+
+def sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 24))).capitalize() + rng.choice([".", ".", ".", "?", "!"])
+
+def paragraph(rng):
+    return " ".join(sentence(rng) for _ in range(rng.randint(2, 8)))
+
+def make_table(rng, page_number, offset, rows, columns):
+    # Cell contents are laid out in the document content in reading order, the table covers them with a single span
+    cells = []
+    parts = []
+    for row in range(rows):
+        for column in range(columns):
+            content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+            cells.append(DocumentTableCell(kind="columnHeader" if row == 0 else "content", row_index=row, column_index=column,
+                                           row_span=1, column_span=1, content=content, bounding_regions=[], spans=[]))
+            parts.append(content)
+    text = " ".join(parts) + "\n"
+    table = DocumentTable(row_count=rows, column_count=columns, cells=cells,
+                          bounding_regions=[BoundingRegion(page_number=page_number, polygon=[])],
+                          spans=[DocumentSpan(offset=offset, length=len(text))])
+    return table, text
+
+# Form Recognizer-like layout results: pages of paragraphs with tables in between. Fractional tables per page
+# are spread over the pages, e.g. 0.2 puts a table on every fifth page
+def make_analyze_result(pages, tables_per_page, rows, columns, seed=0):
+    rng = random.Random(seed)
+    content = []
+    offset = 0
+    result_pages = []
+    tables = []
+    table_budget = 0.0
+    for page_number in range(1, pages + 1):
+        page_offset = offset
+        table_budget += tables_per_page
+        for _ in range(rng.randint(3, 6)):
+            text = paragraph(rng) + "\n"
+            content.append(text)
+            offset += len(text)
+            if table_budget >= 1:
+                table_budget -= 1
+                table, text = make_table(rng, page_number, offset, rows, columns)
+                tables.append(table)
+                content.append(text)
+                offset += len(text)
+        result_pages.append(DocumentPage(page_number=page_number, spans=[DocumentSpan(offset=page_offset, length=offset - page_offset)]))
+    return AnalyzeResult(content="".join(content), pages=result_pages, tables=tables)
+
+# Median time over repeat runs, then one more run under tracemalloc for the peak memory (tracing slows things down too
+# much to time the same run)
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"ms": round(statistics.median(times) * 1000, 2), "peak_mb": round(peak / 2**20, 2)}
+
+def run_scenario(name, repeat):
+    pages, tables_per_page, rows, columns = SCENARIOS[name]
+    result = make_analyze_result(pages, tables_per_page, rows, columns)
+    page_map = prepdocs.get_form_recognizer_page_map(result)
+    return {
+        "page_map": measure(lambda: prepdocs.get_form_recognizer_page_map(result), repeat),
+        "table_to_html": measure(lambda: [prepdocs.table_to_html(t) for t in result.tables], repeat),
+        "split_text": measure(lambda: list(prepdocs.split_text(page_map)), repeat),
+        "create_sections": measure(lambda: list(prepdocs.create_sections("benchmark.pdf", page_map)), repeat),
+    }, {"pages": pages, "tables": len(result.tables), "characters": len(result.content), "sections": len(list(prepdocs.split_text(page_map)))}
+
+def run_pdfs(pattern, repeat):
+    filenames = sorted(glob.glob(pattern))
+    return {
+        "local_parser": measure(lambda: [prepdocs.get_document_text(f) for f in filenames], repeat),
+        "split_pages": measure(lambda: [list(prepdocs.get_blobs(f)) for f in filenames], repeat),
+    }, {"files": len(filenames)}
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline["results"].get(scenario, {}).get(stage)
+            if base is None:
+                continue
+            if result["ms"] > base["ms"] * (1 + tolerance):
+                regressions.append(f"{scenario}/{stage}: {base['ms']}ms -> {result['ms']}ms")
+            if result["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+                regressions.append(f"{scenario}/{stage}: peak {base['peak_mb']}MB -> {result['peak_mb']}MB")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the prepdocs processing stages on synthetic documents.",
+        epilog="Example: python prepdocs_benchmark.py --scenarios small,large --repeat 3 --save prepdocs_baseline.json")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma separated scenarios, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per stage, the median time is reported")
+    parser.add_argument("--pdfs", help="Optional. Also benchmark the local PDF parser and page splitting on these files, e.g. '../data/*.pdf'")
+    parser.add_argument("--save", help="Save the results as a baseline to this JSON file")
+    parser.add_argument("--compare", help="Compare with a saved baseline and exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown and memory growth when comparing with a baseline")
+    args = parser.parse_args()
+
+    # Only the processing functions are used, nothing that needs credentials
+    prepdocs.args = prepdocs.parser.parse_args(["", "--localpdfparser"])
+
+    results = {}
+    print(f"{'scenario':<10}{'stage':<18}{'ms':>10}{'peak MB':>10}")
+    runs = [(name, lambda name=name: run_scenario(name, args.repeat)) for name in args.scenarios.split(",")]
+    if args.pdfs:
+        runs.append(("pdfs", lambda: run_pdfs(args.pdfs, args.repeat)))
+    for name, run in runs:
+        stages, size = run()
+        results[name] = stages
+        print(f"{name:<10}" + ", ".join(f"{k}={v}" for k, v in size.items()))
+        for stage, result in stages.items():
+            print(f"{'':<10}{stage:<18}{result['ms']:>10}{result['peak_mb']:>10}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})")